@@ -0,0 +1,224 @@
+import numpy as np
+from main import room
+
+def stabilityLimit(simulatedRoom:room):
+    # largest stable time step of the explicit engines in seconds: a conductor cell must not
+    # give away more than its own heat in one step, dt <= C_i / sum_j G_ij for every cell i
+    conductance = simulatedRoom.getConductanceMatrix()
+    conductors = simulatedRoom.conductorMask
+    return float(np.min(simulatedRoom.capacities[conductors] / conductance.diagonal()[conductors]))
+
+class adaptiveStepper:
+    # runs a room with a time step that grows while the temperatures move slowly and shrinks
+    # around controller events. A step is redone with a smaller time step when a conductor
+    # cell moves by more than tolerance Kelvin, or when a controller saturates, leaves its
+    # saturation, switches or sees its sensor cell cross its setpoint, until minStep is
+    # reached. The step is never larger than maxStep, which defaults to the stability limit
+    # of the explicit engines (the implicit ones have no such limit).
+    # The time steps are minStep times a power of two, halved on a rejected step and doubled
+    # after a step that moved less than half the tolerance, so the implicit engines only
+    # ever factorize a handful of systems, kept in self.solvers.
+    # The delays of the controllers are counted in steps of the room. While the stepper runs,
+    # a controller with a delay reads the sensor reading held delay*room.timeStep seconds
+    # earlier, from time stamped readings, so that the dead time does not stretch or shrink
+    # with the step, and its ring buffer is rebuilt from them at the end of every step.
+    def __init__(self, simulatedRoom:room, tolerance=0.05, minStep=1, maxStep=None):
+        self.room = simulatedRoom
+        self.tolerance = tolerance
+        self.minStep = minStep
+        if maxStep is None:
+            implicit = simulatedRoom.engine in (room.engineType.implicit, room.engineType.crankNicolson)
+            maxStep = float("inf") if implicit else 0.9*stabilityLimit(simulatedRoom)
+        self.maxStep = max(maxStep, minStep)
+        self.timeStep = minStep
+        self.solvers = {}
+        self.acceptedSteps = 0
+        self.rejectedSteps = 0
+        # dead time of every controller in seconds, set while a step runs with delayed
+        # controllers, and the time stamped sensor readings, kept from step to step as long as
+        # the room is not stepped outside of the stepper
+        self.deadTimes = None
+        self.readingTimes = None
+        self.readings = None
+        self.readingsKey = None
+
+    def saveState(self):
+        controllers = self.room.controllers
+        if self.deadTimes is not None:
+            # the readings older than the one held for the largest dead time are not needed
+            first = np.searchsorted(self.readingTimes, self.room.time - self.deadTimes.max() + 1e-9, side="right") - 1
+            self.readingTimes = self.readingTimes[max(first, 0):]
+            self.readings = self.readings[max(first, 0):]
+        return (self.room.temps.copy(), self.room.time, self.room.stepCount,
+                {name: getattr(controllers, name).copy() for name in controllers.fields},
+                controllers.sensorReadings.copy(), None if self.readingTimes is None else len(self.readingTimes))
+
+    def restoreState(self, state):
+        temps, time, stepCount, fields, sensorReadings, readingCount = state
+        self.room.temps[:] = temps
+        self.room.time = time
+        self.room.stepCount = stepCount
+        for name, array in fields.items():
+            setattr(self.room.controllers, name, array)
+        self.room.controllers.sensorReadings = sensorReadings
+        if readingCount is not None:
+            self.readingTimes = self.readingTimes[:readingCount]
+            self.readings = self.readings[:readingCount]
+
+    def getHeldReadings(self, times):
+        # reading of every controller held at times, one time per controller
+        positions = np.searchsorted(self.readingTimes, times + 1e-9, side="right") - 1
+        return self.readings[np.maximum(positions, 0), np.arange(len(times))]
+
+    def startDelays(self, delays, roomTimeStep):
+        # has the delayed controllers read from the time stamped readings, made from the ring
+        # buffers, taken every roomTimeStep before now, when there are none for this state
+        controllers = self.room.controllers
+        count = controllers.count
+        self.deadTimes = delays * roomTimeStep
+        key = (self.room.time, self.room.stepCount, tuple(self.deadTimes))
+        if self.readingsKey != key:
+            self.readingTimes, self.readings = self.getBufferedReadings(delays, roomTimeStep)
+        controllers.delay[:count] = 0
+        # controllers.update may already be wrapped, by a profiler for instance
+        self.wrappedUpdate = controllers.__dict__.get("update")
+        self.controllerUpdate = controllers.update
+        controllers.update = self.delayedUpdate
+
+    def getBufferedReadings(self, delays, roomTimeStep):
+        # times and readings of the ring buffers, the oldest first
+        controllers = self.room.controllers
+        count = controllers.count
+        lags = np.arange(delays.max(), 0, -1)
+        readingsIndex = controllers.sensorReadingsIndex[:count]
+        columns = (readingsIndex + delays - lags[:,None]) % np.maximum(delays, 1)
+        # controllers without a delay, or a shorter one, never read these older readings
+        readings = np.where(lags[:,None] <= delays, controllers.sensorReadings[np.arange(count), columns], np.nan)
+        return self.room.time - lags*roomTimeStep, readings
+
+    def delayedUpdate(self, temps, timeStep, indices=None, readings=None):
+        controllers = self.room.controllers
+        if readings is None:
+            readings = controllers.readSensors(temps, np.arange(controllers.count))
+        self.readingTimes = np.append(self.readingTimes, self.room.time)
+        self.readings = np.concatenate([self.readings, readings[None,:]])
+        measured = np.where(self.deadTimes > 0, self.getHeldReadings(self.room.time - self.deadTimes), readings)
+        self.controllerUpdate(temps, timeStep, indices, measured)
+
+    def stopDelays(self, delays, roomTimeStep):
+        # back to ring buffers holding the readings every roomTimeStep before now, the oldest
+        # one read first
+        controllers = self.room.controllers
+        count = controllers.count
+        if self.wrappedUpdate is None:
+            del controllers.update
+        else:
+            controllers.update = self.wrappedUpdate
+        for lag in range(1, delays.max()+1):
+            delayed = np.flatnonzero(delays >= lag)
+            held = self.getHeldReadings(self.room.time - lag*roomTimeStep*np.ones(count))
+            controllers.sensorReadings[delayed, delays[delayed]-lag] = held[delayed]
+        controllers.sensorReadingsIndex[:count] = 0
+        controllers.delay[:count] = delays
+        self.readingsKey = (self.room.time, self.room.stepCount, tuple(self.deadTimes))
+        self.deadTimes = None
+
+    def getControllerState(self):
+        # what an event is detected on: saturation, on/off state and whether the sensor cell is
+        # above, below or within tolerance of the setpoint, the band keeps the small
+        # oscillations around a reached setpoint from being events
+        controllers = self.room.controllers
+        count = controllers.count
+        power = controllers.power[:count]
+        offset = self.room.temps[controllers.sensorCells[:count]] - controllers.setpoint[:count]
+        return np.concatenate([power >= controllers.maxPower[:count],
+                               power <= controllers.minPower[:count],
+                               controllers.switchedOn[:count],
+                               np.sign(offset) * (np.abs(offset) > self.tolerance)])
+
+    def transferHeat(self, timeStep, cache=True):
+        self.room.timeStep = timeStep
+        if self.room.engine in (room.engineType.implicit, room.engineType.crankNicolson):
+            # the room drops its factorization when a cell changes, the cached ones are stale too
+            if self.room.implicitSolver is None:
+                self.solvers.clear()
+            # swap in the factorization of this time step when there is one
+            solver = self.solvers.get(timeStep)
+            if solver is not None and solver.room is self.room:
+                self.room.implicitSolver = solver
+            self.room.transferHeat()
+            if cache:
+                self.solvers[timeStep] = self.room.implicitSolver
+        else:
+            self.room.transferHeat()
+
+    def step(self, maxStep=None):
+        # one accepted step no longer than maxStep, returns its length in seconds. The room
+        # keeps its own time step for the steps taken outside of the stepper
+        roomTimeStep = self.room.timeStep
+        controllers = self.room.controllers
+        delays = controllers.delay[:controllers.count].copy()
+        if delays.any():
+            self.startDelays(delays, roomTimeStep)
+        try:
+            return self.takeStep(maxStep)
+        finally:
+            self.room.timeStep = roomTimeStep
+            if delays.any():
+                self.stopDelays(delays, roomTimeStep)
+
+    def takeStep(self, maxStep):
+        limit = self.maxStep if maxStep is None else min(self.maxStep, maxStep)
+        ladderStep = self.timeStep
+        while ladderStep > limit and ladderStep > self.minStep:
+            ladderStep /= 2
+        # the last step of a run may have to be cut to land on its end, the next steps go on
+        # from ladderStep, halved along with it when the cut step is rejected
+        timeStep = min(ladderStep, limit)
+        before = self.getControllerState()
+        while True:
+            state = self.saveState()
+            self.transferHeat(timeStep, timeStep == ladderStep)
+            change = float(np.max(np.abs(self.room.temps - state[0])))
+            event = bool(np.any(self.getControllerState() != before))
+            if (change <= self.tolerance and not event) or timeStep <= self.minStep:
+                break
+            self.rejectedSteps += 1
+            self.restoreState(state)
+            timeStep = max(timeStep/2, self.minStep)
+            ladderStep = max(ladderStep/2, self.minStep)
+        self.acceptedSteps += 1
+        self.timeStep = ladderStep
+        if change < self.tolerance/2 and not event and 2*self.timeStep <= self.maxStep:
+            self.timeStep *= 2
+        return timeStep
+
+    def run(self, duration, outputInterval):
+        # advances the room by duration seconds and returns its inner temperature, heaters
+        # power and sensor cell temperature interpolated on a uniform grid of outputInterval
+        controllers = self.room.controllers
+        times = [self.room.time]
+        innerTemps = [self.room.getInnerTemp()]
+        powers = [controllers.power[:controllers.count].copy()]
+        sensorTemps = [self.room.temps[controllers.sensorCells[:controllers.count]]]
+        end = self.room.time + duration
+        while self.room.time < end - 1e-9:
+            self.step(end - self.room.time)
+            times.append(self.room.time)
+            innerTemps.append(self.room.getInnerTemp())
+            powers.append(controllers.power[:controllers.count].copy())
+            sensorTemps.append(self.room.temps[controllers.sensorCells[:controllers.count]])
+
+        times = np.array(times)
+        grid = np.arange(times[0], end + outputInterval/2, outputInterval)
+        def interpolate(values):
+            values = np.array(values).reshape(len(times), -1)
+            return np.stack([np.interp(grid, times, column) for column in values.T], axis=1)
+        return {
+            "time": grid,
+            "innerTemp": interpolate(innerTemps)[:,0],
+            "power": interpolate(powers),
+            "sensorTemp": interpolate(sensorTemps),
+            "acceptedSteps": self.acceptedSteps,
+            "rejectedSteps": self.rejectedSteps
+        }
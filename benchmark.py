@@ -0,0 +1,179 @@
+import numpy as np, os, sys, json, time, platform, argparse, itertools, tempfile, resource
+from concurrent.futures import ProcessPoolExecutor
+
+# headless benchmark of the simulation hot paths. Every case (grid size, heater count,
+# engine) runs in its own process so that its peak memory is its own, the results are
+# written as json and two result files can be compared to catch regressions.
+
+sizes = [(7, 5), (50, 50), (200, 200), (1000, 1000)]
+heaterCounts = [1, 10, 100, 1000]
+engines = ["sequential", "sequentialCompiled", "vectorized", "implicit", "crankNicolson"]
+quickSizes = [(7, 5), (50, 50), (200, 200)]
+quickHeaterCounts = [1, 100]
+# the pure Python engine is skipped above this many cells, a single step would take seconds
+maxSequentialCells = 60000
+
+def timeRepeated(function, timeBudget, maxRepeats):
+    # mean time of function over as many calls as fit in timeBudget seconds, at least one
+    repeats = 0
+    start = time.perf_counter()
+    while True:
+        function()
+        repeats += 1
+        elapsed = time.perf_counter() - start
+        if repeats >= maxRepeats or elapsed >= timeBudget:
+            return elapsed / repeats, repeats
+
+def peakMemory():
+    # peak resident memory of this process in bytes, ru_maxrss is in kilobytes on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak*1024
+
+def addHeaters(simulatedRoom, heaterCount):
+    # heaters spread over the inner cells, each with its own sensor on the same cell
+    positions = np.linspace(0, simulatedRoom.width*simulatedRoom.height-1, heaterCount).astype(int)
+    for position in positions:
+        x = 2 + position % simulatedRoom.width
+        y = 2 + position // simulatedRoom.width
+        sensor = simulatedRoom.addSensorFromXY(x, y)
+        simulatedRoom.addHeatSourceFromXY(x, y, 0, 10, 0.01, 30, sensor)
+
+def benchmarkCase(width, height, heaterCount, engine, steps=100, timeBudget=2.0):
+    import main
+    from recorder import recorder
+    baselineMemory = peakMemory()
+    air = (0.1, 20.79*88.08)
+    phases = {}
+
+    start = time.perf_counter()
+    simulatedRoom = main.room(width, height, 10, engine)
+    simulatedRoom.initCells(30, *air, 3, 100, 0, *air)
+    phases["initCells"] = time.perf_counter() - start
+    addHeaters(simulatedRoom, heaterCount)
+
+    # the first step builds the edges, factorizations or compiled kernel
+    start = time.perf_counter()
+    simulatedRoom.transferHeat()
+    phases["firstStep"] = time.perf_counter() - start
+
+    phases["transferHeat"], stepsDone = timeRepeated(simulatedRoom.transferHeat, timeBudget, steps)
+    phases["getInnerTemp"], _ = timeRepeated(simulatedRoom.getInnerTemp, timeBudget/4, steps)
+    phases["getTemperatureMap"], _ = timeRepeated(simulatedRoom.getTemperatureMap, timeBudget/4, steps)
+    phases["heaterUpdate"], _ = timeRepeated(lambda: simulatedRoom.controllers.update(simulatedRoom.temps, simulatedRoom.timeStep), timeBudget/4, steps)
+
+    # simulate() like run: step, record the series every step and a map every 10 steps
+    with tempfile.TemporaryDirectory() as outputPath:
+        with recorder(outputPath, ["innerTemp", "sensorTemp", "heaterPower"], simulatedRoom.getTemperatureMap().shape) as output:
+            def simulateStep():
+                simulatedRoom.transferHeat()
+                step = simulatedRoom.stepCount
+                output.record(step, simulatedRoom.time, (simulatedRoom.getInnerTemp(), simulatedRoom.heatSources[0].sensor.getTemp(), simulatedRoom.heatSources[0].power))
+                if output.wantsFrame(step):
+                    output.recordFrame(step, simulatedRoom.time, simulatedRoom.getTemperatureMap())
+            phases["simulateStep"], simulateSteps = timeRepeated(simulateStep, timeBudget, steps)
+
+    return {
+        "width": width,
+        "height": height,
+        "cells": len(simulatedRoom.temps),
+        "heaters": heaterCount,
+        "engine": engine,
+        "steps": stepsDone,
+        "simulateSteps": simulateSteps,
+        "stepsPerSecond": 1 / phases["transferHeat"],
+        "simulateStepsPerSecond": 1 / phases["simulateStep"],
+        "peakMemory": peakMemory(),
+        "roomMemory": peakMemory() - baselineMemory,
+        "phases": phases # mean seconds per call
+    }
+
+def getCases(sizes, heaterCounts, engines):
+    cases = []
+    for (width, height), heaterCount, engine in itertools.product(sizes, heaterCounts, engines):
+        if heaterCount > width*height:
+            continue
+        if engine == "sequential" and (width+4)*(height+4) > maxSequentialCells:
+            continue
+        cases.append((width, height, heaterCount, engine))
+    return cases
+
+def getEnvironment():
+    environment = {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S")
+    }
+    try:
+        import numba
+        environment["numba"] = numba.__version__
+    except ImportError:
+        environment["numba"] = None
+    return environment
+
+def runBenchmarks(cases, outputPath, steps=100, timeBudget=2.0, verbose=True):
+    results = []
+    for case in cases:
+        # a new process per case, so the peak memory and the compiled kernels start from scratch
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            result = executor.submit(benchmarkCase, *case, steps, timeBudget).result()
+        results.append(result)
+        if verbose:
+            print(f"{result['engine']:>18} {result['width']:>4}x{result['height']:<4} {result['heaters']:>4} heaters "
+                  f"{result['stepsPerSecond']:10.1f} steps/s {result['roomMemory']/2**20:8.1f} MiB")
+        # rewrite the file after every case so that a long run can be looked at while it goes
+        with open(outputPath, "w") as f:
+            json.dump({"environment": getEnvironment(), "results": results}, f, indent=1)
+    return results
+
+def compareBenchmarks(oldPath, newPath, threshold=0.2):
+    # cases of newPath that got slower than oldPath by more than threshold (0.2 is 20%) on
+    # a phase, or that use that much more memory
+    with open(oldPath) as f:
+        old = {getKey(result): result for result in json.load(f)["results"]}
+    with open(newPath) as f:
+        new = json.load(f)["results"]
+    regressions = []
+    for result in new:
+        previous = old.get(getKey(result))
+        if previous is None:
+            continue
+        for phase, seconds in result["phases"].items():
+            before = previous["phases"].get(phase)
+            if before and seconds > before*(1+threshold):
+                regressions.append((getKey(result), phase, before, seconds))
+        if previous["roomMemory"] > 0 and result["roomMemory"] > previous["roomMemory"]*(1+threshold):
+            regressions.append((getKey(result), "roomMemory", previous["roomMemory"], result["roomMemory"]))
+    return regressions
+
+def getKey(result):
+    return f"{result['engine']} {result['width']}x{result['height']} {result['heaters']} heaters"
+
+def main():
+    parser = argparse.ArgumentParser(description="benchmark the simulation hot paths")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run")
+    run.add_argument("--output", default="benchmark.json")
+    run.add_argument("--quick", action="store_true", help="grids up to 200x200 and 1 or 100 heaters")
+    run.add_argument("--engines", nargs="+", default=engines)
+    run.add_argument("--steps", type=int, default=100, help="maximum number of calls timed per phase")
+    run.add_argument("--time-budget", type=float, default=2.0, help="seconds spent on each phase")
+    compare = commands.add_parser("compare")
+    compare.add_argument("old")
+    compare.add_argument("new")
+    compare.add_argument("--threshold", type=float, default=0.2)
+    arguments = parser.parse_args()
+
+    if arguments.command == "run":
+        cases = getCases(quickSizes if arguments.quick else sizes, quickHeaterCounts if arguments.quick else heaterCounts, arguments.engines)
+        runBenchmarks(cases, arguments.output, arguments.steps, arguments.time_budget)
+    else:
+        regressions = compareBenchmarks(arguments.old, arguments.new, arguments.threshold)
+        for key, phase, before, after in regressions:
+            print(f"{key} {phase}: {before:.6g} -> {after:.6g} ({after/before-1:+.0%})")
+        sys.exit(1 if regressions else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+import numpy as np
+
+class controllerType:
+    # power = p*error + i*integral (+ d*derivative for pid), clamped to [minPower, maxPower]
+    pi = 0
+    pid = 1
+    # maxPower below the setpoint, minPower above
+    onOff = 2
+    # like onOff but only switches once the error leaves [-hysteresis/2, hysteresis/2]
+    bangBang = 3
+    # power set from outside, by a thermostat under test for instance, only clamped
+    manual = 4
+
+class controllerBank:
+    # state of all the heater controllers of a room as arrays, one entry per heater, updated
+    # for every heater in a single call. heater objects are views over one index of a bank.
+    #
+    # a controller with a delay > 0 acts on the reading taken delay updates earlier, kept in a
+    # ring buffer per controller. With antiWindup the integral stops growing while the output
+    # is saturated and the error would push it further into saturation.
+    fields = {
+        "cells": np.intp, # cell id where the power is injected
+        "sensorCells": np.intp, # cell id read by the sensor
+        "type": np.int8,
+        "power": float, # in Watts
+        "p": float,
+        "i": float,
+        "d": float,
+        "setpoint": float,
+        "integral": float,
+        "lastError": float,
+        "minPower": float,
+        "maxPower": float,
+        "hysteresis": float,
+        "antiWindup": bool,
+        "switchedOn": bool,
+        "delay": np.intp,
+        "sensorReadingsIndex": np.intp
+    }
+
+    def __init__(self, rng:np.random.Generator, noise=0.05, capacity=4):
+        self.rng = rng
+        self.noise = noise # standard deviation of the sensors readings in Kelvin
+        self.count = 0
+        for name, dtype in self.fields.items():
+            setattr(self, name, np.zeros(capacity, dtype=dtype))
+        self.sensorReadings = np.zeros((capacity, 1))
+        # thermometer objects of the controllers, for the heater views
+        self.sensors = []
+
+    def __len__(self):
+        return self.count
+
+    def reserve(self, capacity, delay=1):
+        # grow the arrays geometrically so that adding thousands of controllers stays linear
+        oldCapacity = len(self.power)
+        if capacity > oldCapacity:
+            newCapacity = max(capacity, 2*oldCapacity)
+            for name in self.fields:
+                array = getattr(self, name)
+                grown = np.zeros(newCapacity, dtype=array.dtype)
+                grown[:oldCapacity] = array
+                setattr(self, name, grown)
+        rows, columns = self.sensorReadings.shape
+        if len(self.power) > rows or delay > columns:
+            grown = np.zeros((len(self.power), max(delay, columns)))
+            grown[:rows, :columns] = self.sensorReadings
+            self.sensorReadings = grown
+
+    def add(self, cell, sensor, sensorCell, power, p, i, setpoint, delay=0, type=controllerType.pi, d=0, hysteresis=0.5, antiWindup=False, minPower=0, maxPower=1000):
+        self.reserve(self.count+1, delay)
+        index = self.count
+        values = {
+            "cells": cell, "sensorCells": sensorCell, "type": type, "power": power,
+            "p": p, "i": i, "d": d, "setpoint": setpoint, "integral": 0, "lastError": 0,
+            "minPower": minPower, "maxPower": maxPower, "hysteresis": hysteresis,
+            "antiWindup": antiWindup, "switchedOn": False, "delay": delay, "sensorReadingsIndex": 0
+        }
+        for name, value in values.items():
+            getattr(self, name)[index] = value
+        if delay > 0:
+            # filled with a first reading, like the delay buffer of the original heater
+            self.sensorReadings[index, :delay] = sensor.getTemp()
+        self.sensors.append(sensor)
+        self.count += 1
+        return index
+
+    def readSensors(self, temps, indices):
+        return temps[self.sensorCells[indices]] + self.rng.normal(0, self.noise, len(indices))
+
+    def update(self, temps, timeStep, indices=None, readings=None):
+        # one control step for the given controllers, all of them by default, from readings
+        # of their sensors when they were already taken
+        if indices is None:
+            indices = np.arange(self.count)
+        if len(indices) == 0:
+            return
+        if readings is None:
+            readings = self.readSensors(temps, indices)
+
+        delay = self.delay[indices]
+        delayed = delay > 0
+        readingsIndex = self.sensorReadingsIndex[indices]
+        measured = np.where(delayed, self.sensorReadings[indices, readingsIndex], readings)
+        self.sensorReadings[indices[delayed], readingsIndex[delayed]] = readings[delayed]
+        self.sensorReadingsIndex[indices] = np.where(delayed, (readingsIndex+1) % np.maximum(delay, 1), 0)
+
+        error = self.setpoint[indices] - measured
+        minPower = self.minPower[indices]
+        maxPower = self.maxPower[indices]
+        controller = self.type[indices]
+
+        integral = self.integral[indices] + error * timeStep
+        derivative = np.where(controller == controllerType.pid, (error - self.lastError[indices]) / timeStep, 0)
+        output = self.p[indices]*error + self.i[indices]*integral + self.d[indices]*derivative
+        windup = self.antiWindup[indices] & (((output > maxPower) & (error > 0)) | ((output < minPower) & (error < 0)))
+        # manual controllers keep the integral they had when taken over, to hand back smoothly
+        manual = controller == controllerType.manual
+        self.integral[indices] = np.where(windup | manual, self.integral[indices], integral)
+        output = np.minimum(np.maximum(output, minPower), maxPower)
+
+        halfBand = np.where(controller == controllerType.bangBang, self.hysteresis[indices]/2, 0)
+        switchedOn = np.where(error > halfBand, True, np.where(error < -halfBand, False, self.switchedOn[indices]))
+        self.switchedOn[indices] = switchedOn
+        switching = (controller == controllerType.onOff) | (controller == controllerType.bangBang)
+        output = np.where(manual, np.minimum(np.maximum(self.power[indices], minPower), maxPower), output)
+        self.power[indices] = np.where(switching, np.where(switchedOn, maxPower, minPower), output)
+        self.lastError[indices] = error
+
+    def getCellPowers(self, cellCount):
+        # power of the controllers scattered on the cells in Watts, controllers sharing a cell add up
+        # bincount gives integers when there are no weights at all
+        return np.bincount(self.cells[:self.count], self.power[:self.count], cellCount).astype(float, copy=False)
@@ -0,0 +1,115 @@
+import numpy as np
+from main import room, cell
+from controllers import controllerBank, controllerType
+
+class ensemble:
+    # runs many heater tuning scenarios over the geometry of one room at once, the
+    # temperatures are stored as a (cells, scenarios) array, so that one sparse product with
+    # the conductance matrix moves the heat of every scenario, and advanced with the same
+    # explicit update as the vectorized engine of room (heat sinks at a fixed temperature)
+    #
+    # every heater parameter can be a scalar shared by all the scenarios, a (scenarios,) array
+    # or a (scenarios, heaters) array. The heaters of all the scenarios are the controllers of
+    # one controllerBank over the flattened temperatures, controller takes the other
+    # controllerBank.add settings: type, d, hysteresis, antiWindup and minPower
+    def __init__(self, baseRoom:room, heaterCells, sensorCells, p, i, setpoint, delay=0, outerTemp=None, maxPower=1000, seed=0, **controller):
+        # heaterCells and sensorCells are (heaters,) or (scenarios, heaters)
+        heaterCells = np.atleast_1d(np.asarray(heaterCells, dtype=int))
+        sensorCells = np.atleast_1d(np.asarray(sensorCells, dtype=int))
+        heaterCount = heaterCells.shape[-1]
+        scenarioCount = 1
+        for value in (heaterCells, sensorCells):
+            if value.ndim == 2:
+                scenarioCount = max(scenarioCount, value.shape[0])
+        for value in (p, i, setpoint, delay, outerTemp, maxPower, *controller.values()):
+            if np.ndim(value) >= 1:
+                scenarioCount = max(scenarioCount, np.shape(value)[0])
+        shape = (scenarioCount, heaterCount)
+
+        def perHeater(value, dtype=float):
+            # (scenarios,) values are shared by the heaters of a scenario
+            value = np.asarray(value, dtype=dtype)
+            if value.ndim == 1:
+                value = value[:,None]
+            return np.broadcast_to(value, shape).copy()
+
+        def perCell(value):
+            return np.broadcast_to(value, shape).copy()
+
+        self.room = baseRoom
+        self.timeStep = baseRoom.timeStep
+        self.heaterCells = perCell(heaterCells)
+        self.sensorCells = perCell(sensorCells)
+        self.rng = np.random.default_rng(seed)
+
+        self.conductance = baseRoom.getConductanceMatrix()
+        self.conductorMask = baseRoom.types == cell.cellType.conductor
+        self.sinks = np.flatnonzero(~self.conductorMask)
+        self.capacities = baseRoom.capacities[:,None]
+        self.temps = np.repeat(baseRoom.temps[:,None], scenarioCount, axis=1)
+        if outerTemp is not None:
+            self.temps[self.sinks] = np.broadcast_to(np.asarray(outerTemp, dtype=float), (scenarioCount,))
+        self.innerCells = baseRoom.getInnerIds()
+
+        # cells of the controllers are ids in the flattened (cells, scenarios) temperatures
+        scenarios = np.arange(scenarioCount)[:,None]
+        self.controllers = controllerBank(self.rng)
+        delay = perHeater(delay, int)
+        self.controllers.reserve(scenarioCount*heaterCount, max(int(delay.max()), 1))
+        settings = {"cells": self.heaterCells*scenarioCount + scenarios, "sensorCells": self.sensorCells*scenarioCount + scenarios,
+                    "type": controllerType.pi, "p": p, "i": i, "setpoint": setpoint, "delay": delay, "maxPower": maxPower,
+                    "minPower": 0, "hysteresis": 0.5, **controller}
+        for name, value in settings.items():
+            getattr(self.controllers, name)[:scenarioCount*heaterCount] = perHeater(value, self.controllers.fields[name]).ravel()
+        self.controllers.count = scenarioCount*heaterCount
+        self.indices = np.arange(self.controllers.count)
+        # ring buffers of the delayed sensor readings, filled with the first reading like heater
+        self.controllers.sensorReadings[:self.controllers.count] = self.readSensors().ravel()[:,None]
+        self.sensorTemp = self.readSensors()
+
+    @property
+    def power(self):
+        return self.controllers.power[:self.controllers.count].reshape(self.heaterCells.shape)
+
+    def readSensors(self):
+        return self.controllers.readSensors(self.temps.reshape(-1), self.indices).reshape(self.heaterCells.shape)
+
+    def updateHeaters(self):
+        self.sensorTemp = self.readSensors()
+        self.controllers.update(self.temps.reshape(-1), self.timeStep, self.indices, self.sensorTemp.ravel())
+
+    def transferHeat(self):
+        self.updateHeaters()
+        controllers = self.controllers
+        # the conductance matrix gives the heat leaving each cell, the heaters add theirs to
+        # their own cells only
+        joules = self.conductance @ self.temps
+        joules *= -self.timeStep
+        np.add.at(joules.reshape(-1), controllers.cells[:controllers.count], controllers.power[:controllers.count]*self.timeStep)
+        joules /= self.capacities
+        joules[self.sinks] = 0
+        self.temps += joules
+
+    def getInnerTemp(self):
+        return self.temps[self.innerCells].mean(axis=0)
+
+    def run(self, steps):
+        # returns the time series stacked as (steps, scenarios) and (steps, scenarios, heaters)
+        scenarioCount, heaterCount = self.power.shape
+        innerTemp = np.empty((steps, scenarioCount))
+        sensorTemp = np.empty((steps, scenarioCount, heaterCount))
+        power = np.empty((steps, scenarioCount, heaterCount))
+        for step in range(steps):
+            self.transferHeat()
+            innerTemp[step] = self.getInnerTemp()
+            sensorTemp[step] = self.sensorTemp
+            power[step] = self.power
+        return {
+            "time": self.timeStep*np.arange(1, steps+1),
+            "innerTemp": innerTemp,
+            "sensorTemp": sensorTemp,
+            "power": power
+        }
+
+def simulateEnsemble(baseRoom:room, steps, heaterCells, sensorCells, p, i, setpoint, delay=0, outerTemp=None, seed=0, **controller):
+    return ensemble(baseRoom, heaterCells, sensorCells, p, i, setpoint, delay, outerTemp, seed=seed, **controller).run(steps)
@@ -0,0 +1,150 @@
+import numpy as np, json
+import scipy.ndimage as ndimage
+from matplotlib import image
+from main import room, cell, getGridNeighbors
+
+airCapacity = 20.79*88.08 # Joules/Kelvin
+
+# material of every kind of cell of a plan, "type" is "conductor" or "heatSink", "temp" is the
+# initial temperature, innerTemp or outerTemp when it is not given, and the cells of materials
+# with "zone" are split into the rooms of the plan
+defaultMaterials = {
+    "outside": {"type": "heatSink", "resistance": 0.1, "capacity": airCapacity},
+    "air": {"type": "conductor", "resistance": 0.1, "capacity": airCapacity, "zone": True},
+    "wall": {"type": "conductor", "resistance": 3, "capacity": 100},
+    "door": {"type": "conductor", "resistance": 0.5, "capacity": 2000},
+    "window": {"type": "conductor", "resistance": 1, "capacity": 500}
+}
+
+# characters of the text plans, spaces are left out of the simulation
+defaultLegend = {" ": None, "O": "outside", "#": "wall", ".": "air", "D": "door", "W": "window"}
+
+class floorPlan:
+    # a building drawn on a grid of 1 meter cells, materials[codes[x, y]] is the material of
+    # the cell at x, y and -1 marks positions that are not simulated.
+    # The room built from a plan only holds the simulated cells, without the positions left
+    # out, nor the outside cells that touch no conductor, so a sprawling building costs its
+    # own cells and not its bounding box. The neighbors of the cells are kept as a sparse row
+    # index, like every room, so the engines only ever visit real cells.
+    # The positions of the cells are those of the plan grid, seen by the room as its usual
+    # (width+4)x(height+4) grid with width and height the plan size minus 4.
+    def __init__(self, codes, materials:dict, innerTemp=20, outerTemp=0):
+        self.codes = np.asarray(codes, dtype=np.int32)
+        self.materialNames = list(materials)
+        self.materials = [dict(defaultMaterials.get(name, {}), **material) for name, material in materials.items()]
+        for name, material in zip(self.materialNames, self.materials):
+            for key in ("type", "resistance", "capacity"):
+                if key not in material:
+                    raise ValueError(f"material {name} has no {key}")
+        self.innerTemp = innerTemp
+        self.outerTemp = outerTemp
+        self.sensors = []
+        self.heatSources = []
+
+    @classmethod
+    def fromStrings(cls, lines, legend=None, materials=None, **args):
+        # a plan drawn as text, one line per y and one character per x
+        legend = dict(defaultLegend, **(legend or {}))
+        materials = dict(defaultMaterials, **(materials or {}))
+        width = max(len(line) for line in lines)
+        names = list(materials)
+        codes = np.full((width, len(lines)), -1, dtype=np.int32)
+        for y, line in enumerate(lines):
+            for x, character in enumerate(line):
+                if character not in legend:
+                    raise ValueError(f"unknown character {character!r} at ({x}, {y})")
+                if legend[character] is not None:
+                    codes[x, y] = names.index(legend[character])
+        return cls(codes, materials, **args)
+
+    @classmethod
+    def fromImage(cls, path, palette, materials=None, **args):
+        # a plan drawn as an image, one pixel per cell, palette maps "#rrggbb" colors to
+        # material names or None for the pixels left out
+        materials = dict(defaultMaterials, **(materials or {}))
+        names = list(materials)
+        pixels = image.imread(path)
+        if pixels.dtype != np.uint8:
+            pixels = np.round(pixels*255).astype(np.uint8)
+        pixels = pixels.reshape(pixels.shape[0], pixels.shape[1], -1)[:,:,:3]
+        colors = (pixels[:,:,0].astype(np.int32) << 16) | (pixels[:,:,1].astype(np.int32) << 8) | pixels[:,:,2]
+        codes = np.full(colors.shape, -2, dtype=np.int32)
+        for color, name in palette.items():
+            codes[colors == int(color.lstrip("#"), 16)] = -1 if name is None else names.index(name)
+        if (codes == -2).any():
+            y, x = np.argwhere(codes == -2)[0]
+            raise ValueError(f"color #{colors[y, x]:06x} at ({x}, {y}) is not in the palette")
+        # images are stored row by row, one row per y
+        return cls(codes.T, materials, **args)
+
+    @classmethod
+    def fromDict(cls, spec):
+        # plan, legend, materials, innerTemp and outerTemp as read from a json file like
+        # templateRoom.json, with the sensors and heat sources to add to the room
+        plan = cls.fromStrings(spec["plan"], spec.get("legend"), spec.get("materials"),
+                               innerTemp=spec.get("innerTemp", 20), outerTemp=spec.get("outerTemp", 0))
+        plan.sensors = spec.get("sensors", [])
+        plan.heatSources = spec.get("heatSources", [])
+        return plan
+
+    @classmethod
+    def loadPlan(cls, path):
+        with open(path) as f:
+            return cls.fromDict(json.load(f))
+
+    def getMaterialArray(self, key, default=None):
+        values = [material.get(key, default) for material in self.materials]
+        return np.array(values)
+
+    def buildRoom(self, timeStep=10, engine=room.engineType.sequential, seed=0):
+        width, height = self.codes.shape
+        simulated = self.codes >= 0
+        codes = np.where(simulated, self.codes, 0)
+        heatSinks = simulated & (self.getMaterialArray("type")[codes] == "heatSink")
+        conductors = simulated & ~heatSinks
+        # outside cells only matter next to a conductor
+        touching = ndimage.binary_dilation(conductors, structure=ndimage.generate_binary_structure(2, 1))
+        kept = conductors | (heatSinks & touching)
+
+        # ids of the kept cells in position key order, -1 elsewhere
+        keys = np.flatnonzero(kept)
+        grid = np.full(kept.size, -1, dtype=np.int32)
+        grid[keys] = np.arange(len(keys))
+        neighbors = getGridNeighbors(grid.reshape(width, height))[keys]
+
+        cellCodes = codes.reshape(-1)[keys]
+        defaultTemps = np.where(self.getMaterialArray("type") == "heatSink", self.outerTemp, self.innerTemp)
+        temps = np.array([material.get("temp", default) for material, default in zip(self.materials, defaultTemps)], dtype=float)[cellCodes]
+        types = np.where(heatSinks.reshape(-1)[keys], cell.cellType.heatSink, cell.cellType.conductor)
+
+        # rooms are the 4 connected groups of zone cells, doors and walls separate them
+        zoneCells = simulated & self.getMaterialArray("zone", False).astype(bool)[codes]
+        labels, roomCount = ndimage.label(zoneCells)
+        self.zoneLabels = labels.reshape(-1)[keys]
+        self.cellCodes = cellCodes
+        self.roomCount = roomCount
+
+        planRoom = room(width-4, height-4, timeStep, engine, seed)
+        temps = temps + [planRoom.rng.gauss(0,0.1) for _ in range(len(keys))]
+        planRoom.setCells(temps, self.getMaterialArray("resistance").astype(float)[cellCodes],
+                          self.getMaterialArray("capacity").astype(float)[cellCodes], types, neighbors,
+                          keys, np.flatnonzero(self.zoneLabels > 0))
+        planRoom.outerTemp = self.outerTemp
+
+        for sensor in self.sensors:
+            planRoom.addSensorFromXY(sensor["x"], sensor["y"])
+        for heatSource in self.heatSources:
+            heatSource = dict(heatSource)
+            sensor = planRoom.sensors[heatSource.pop("sensor")]
+            planRoom.addHeatSourceFromXY(heatSource.pop("x"), heatSource.pop("y"), heatSource.pop("power", 0), heatSource.pop("p"),
+                                         heatSource.pop("i"), heatSource.pop("setpoint"), sensor, **heatSource)
+        return planRoom
+
+    def getMaterialIds(self, name):
+        # cell ids of the cells of a material from the last buildRoom, the windows to put
+        # solar gains on for instance
+        return np.flatnonzero(self.cellCodes == self.materialNames.index(name))
+
+    def getZones(self):
+        # cell ids of every room of the plan from the last buildRoom, for observables.addZone
+        return {f"room{label}": np.flatnonzero(self.zoneLabels == label) for label in range(1, self.roomCount+1)}
@@ -0,0 +1,70 @@
+import numpy as np
+from main import cell
+
+class observables:
+    # mean temperature, stored heat, minimum and maximum temperature of any number of zones
+    # of a room, computed together: the temperatures of the cells of every zone are gathered
+    # once and reduced zone by zone with reduceat, so the cost grows with the number of zone
+    # cells and not with the size of the grid or the number of zones.
+    # The zones are fixed sets of cells, given as a boolean mask indexed by cell id, a mask
+    # shaped like room.getTemperatureMap() or an array of cell ids. The "inner" zone, the
+    # cells averaged by room.getInnerTemp, is always there.
+    def __init__(self, simulatedRoom):
+        self.room = simulatedRoom
+        self.zones:dict[str, np.ndarray] = {}
+        self.cellIds:np.ndarray = None
+        self.addZone("inner", simulatedRoom.getInnerIds())
+
+    def addZone(self, name, cells):
+        cells = np.asarray(cells)
+        if cells.dtype == bool and cells.ndim == 2:
+            ids = self.room.getCellIdsFromMap(cells)
+        elif cells.dtype == bool:
+            if cells.size != len(self.room.temps):
+                raise ValueError(f"zone {name} mask has {cells.size} cells, the room has {len(self.room.temps)}")
+            ids = np.flatnonzero(cells)
+        else:
+            ids = np.unique(cells.reshape(-1).astype(np.intp))
+        if len(ids) == 0:
+            raise ValueError(f"zone {name} has no cells")
+        self.zones[name] = ids
+        self.cellIds = None
+
+    def removeZone(self, name):
+        del self.zones[name]
+        self.cellIds = None
+
+    def build(self):
+        # the zone cells one zone after the other, and where each zone starts, for reduceat
+        ids = list(self.zones.values())
+        self.counts = np.array([len(zone) for zone in ids])
+        self.cellIds = np.concatenate(ids)
+        self.starts = np.concatenate([[0], np.cumsum(self.counts)[:-1]])
+
+    def getArrays(self):
+        # mean temperatures, stored heat in Joules, minimum and maximum temperatures of the
+        # zones as arrays in the order of self.zones
+        if self.cellIds is None:
+            self.build()
+        zoneTemps = self.room.temps[self.cellIds]
+        means = np.add.reduceat(zoneTemps, self.starts) / self.counts
+        energies = np.add.reduceat(zoneTemps*self.room.capacities[self.cellIds], self.starts)
+        return means, energies, np.minimum.reduceat(zoneTemps, self.starts), np.maximum.reduceat(zoneTemps, self.starts)
+
+    def getValues(self):
+        # {zone: {"mean", "energy", "min", "max"}}
+        arrays = self.getArrays()
+        return {name: {"mean": float(arrays[0][k]), "energy": float(arrays[1][k]), "min": float(arrays[2][k]), "max": float(arrays[3][k])}
+                for k, name in enumerate(self.zones)}
+
+    def getSeriesNames(self):
+        # names of the values returned by getSeries, to create a recorder with
+        return [f"{name}.{quantity}" for quantity in ("mean", "energy", "min", "max") for name in self.zones]
+
+    def getSeries(self):
+        return np.concatenate(self.getArrays())
+
+    def getTotalEnergy(self):
+        # heat stored in all the conductor cells in Joules, the heat sinks are infinite reservoirs
+        conductors = self.room.types == cell.cellType.conductor
+        return float(np.dot(self.room.temps[conductors], self.room.capacities[conductors]))
@@ -0,0 +1,168 @@
+import numpy as np, time
+
+class roomProfiler:
+    # wall time and call counts of the phases of room.transferHeat and of the room observers,
+    # plus the energy balance of every step. Attaching it shadows the profiled methods of the
+    # room and of its controller bank with timed wrappers on the instances, detaching removes
+    # them, so a room without a profiler runs the exact same code as before.
+    #
+    # The phases of a step are sort (getSortIndex, sequential engines only), heaterUpdate
+    # (controllers.update), injection (getHeatSourcePowers) and exchange, the rest of the
+    # step.
+    #
+    # The energy balance compares the change of the heat stored in the conductor cells to the
+    # heat injected in them minus the heat lost to the heat sinks, taken at the start of the
+    # step for the explicit engines, at the end for implicit and averaged for crankNicolson.
+    # It closes to rounding for the vectorized and implicit engines, the sequential engines
+    # exchange in order within a step so their drift measures how far they are from it.
+    stepPhases = ("sort", "heaterUpdate", "injection", "exchange")
+    observers = ("getInnerTemp", "getTemperatureMap")
+
+    def __init__(self, simulatedRoom, energyBalance=True, onStep=None):
+        # onStep(stepReport) is called after every step with the phase times of that step and,
+        # with energyBalance, its energy terms in Joules
+        self.room = simulatedRoom
+        self.energyBalance = energyBalance
+        self.onStep = onStep
+        self.boundary = None
+        self.attached = False
+        self.reset()
+
+    def reset(self):
+        self.steps = 0
+        self.times = dict.fromkeys(self.stepPhases + self.observers, 0.0)
+        self.calls = dict.fromkeys(self.stepPhases + self.observers, 0)
+        self.energy = {"stored": 0.0, "injected": 0.0, "lost": 0.0, "drift": 0.0, "maxStepDrift": 0.0}
+        self.stepTimes = None
+
+    def timed(self, phase, function):
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            self.times[phase] += elapsed
+            self.calls[phase] += 1
+            if self.stepTimes is not None:
+                self.stepTimes[phase] += elapsed
+            return result
+        return wrapper
+
+    def attach(self):
+        if self.attached:
+            return self
+        simulatedRoom = self.room
+        self.transferHeat = simulatedRoom.transferHeat
+        simulatedRoom.transferHeat = self.profiledTransferHeat
+        simulatedRoom.getSortIndex = self.timed("sort", simulatedRoom.getSortIndex)
+        simulatedRoom.getHeatSourcePowers = self.timed("injection", simulatedRoom.getHeatSourcePowers)
+        simulatedRoom.getInnerTemp = self.timed("getInnerTemp", simulatedRoom.getInnerTemp)
+        simulatedRoom.getTemperatureMap = self.timed("getTemperatureMap", simulatedRoom.getTemperatureMap)
+        self.controllers = simulatedRoom.controllers
+        self.controllers.update = self.timed("heaterUpdate", self.controllers.update)
+        simulatedRoom.profiler = self
+        self.attached = True
+        return self
+
+    def detach(self):
+        if not self.attached:
+            return
+        for name in ("transferHeat", "getSortIndex", "getHeatSourcePowers", "getInnerTemp", "getTemperatureMap"):
+            delattr(self.room, name)
+        del self.controllers.update
+        self.room.profiler = None
+        self.attached = False
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, type, value, traceback):
+        self.detach()
+
+    def getBoundary(self):
+        # conductor cell and heat sink of every edge between the two, rebuilt with the edges
+        simulatedRoom = self.room
+        if simulatedRoom.edgeSources is None:
+            simulatedRoom.buildArrays()
+        if self.boundary is None or self.boundary[0] is not simulatedRoom.edgeSources:
+            sources, targets = simulatedRoom.edgeSources, simulatedRoom.edgeTargets
+            conductors = simulatedRoom.conductorMask
+            crossing = conductors[sources] != conductors[targets]
+            inner = np.where(conductors[sources], sources, targets)[crossing]
+            outer = np.where(conductors[sources], targets, sources)[crossing]
+            self.boundary = (simulatedRoom.edgeSources, inner, outer, simulatedRoom.edgeConductances[crossing])
+        return self.boundary[1:]
+
+    def getEnergyState(self):
+        # heat stored in the conductors in Joules and heat flowing to the heat sinks in Watts
+        simulatedRoom = self.room
+        inner, outer, conductances = self.getBoundary()
+        temps = simulatedRoom.temps
+        conductors = simulatedRoom.conductorMask
+        stored = float(np.dot(temps[conductors], simulatedRoom.capacities[conductors]))
+        loss = float(np.dot(temps[inner] - temps[outer], conductances))
+        return stored, loss
+
+    def profiledTransferHeat(self):
+        simulatedRoom = self.room
+        self.stepTimes = dict.fromkeys(self.stepPhases, 0.0)
+        if self.energyBalance:
+            storedBefore, _ = self.getEnergyState()
+            inner, outer, conductances = self.getBoundary()
+            innerBefore = self.room.temps[inner]
+        start = time.perf_counter()
+        self.transferHeat()
+        elapsed = time.perf_counter() - start
+        exchange = elapsed - self.stepTimes["sort"] - self.stepTimes["heaterUpdate"] - self.stepTimes["injection"]
+        self.stepTimes["exchange"] = exchange
+        self.times["exchange"] += exchange
+        self.calls["exchange"] += 1
+        self.steps += 1
+        stepReport = {"step": simulatedRoom.stepCount, "time": simulatedRoom.time, "phases": self.stepTimes}
+        self.stepTimes = None
+
+        if self.energyBalance:
+            storedAfter, lossAfter = self.getEnergyState()
+            # the boundary sets the heat sinks at the start of transferHeat, the step runs from
+            # the conductors as they were and the sinks as they are now
+            lossBefore = float(np.dot(innerBefore - simulatedRoom.temps[outer], conductances))
+            timeStep = simulatedRoom.timeStep
+            theta = {simulatedRoom.engineType.implicit: 1, simulatedRoom.engineType.crankNicolson: 0.5}.get(simulatedRoom.engine, 0)
+            powers = type(simulatedRoom).getHeatSourcePowers(simulatedRoom)
+            injected = float(powers[simulatedRoom.conductorMask].sum()) * timeStep
+            lost = ((1-theta)*lossBefore + theta*lossAfter) * timeStep
+            stored = storedAfter - storedBefore
+            drift = stored - injected + lost
+            self.energy["stored"] += stored
+            self.energy["injected"] += injected
+            self.energy["lost"] += lost
+            self.energy["drift"] += drift
+            self.energy["maxStepDrift"] = max(self.energy["maxStepDrift"], abs(drift))
+            stepReport["energy"] = {"stored": stored, "injected": injected, "lost": lost, "drift": drift}
+
+        if self.onStep is not None:
+            self.onStep(stepReport)
+
+    def getReport(self):
+        # totals since the last reset: seconds, calls and mean seconds per call of every phase,
+        # and the energy balance in Joules with the drift relative to the heat moved
+        phases = {name: {"time": self.times[name], "calls": self.calls[name],
+                         "mean": self.times[name] / self.calls[name] if self.calls[name] else 0.0}
+                  for name in self.stepPhases + self.observers}
+        stepTime = sum(self.times[name] for name in self.stepPhases)
+        report = {"steps": self.steps, "stepTime": stepTime, "phases": phases}
+        if self.energyBalance:
+            energy = dict(self.energy)
+            moved = abs(energy["injected"]) + abs(energy["lost"])
+            energy["relativeDrift"] = abs(energy["drift"]) / moved if moved else 0.0
+            report["energy"] = energy
+        return report
+
+    def printReport(self):
+        report = self.getReport()
+        print(f"{report['steps']} steps in {report['stepTime']:.4f} s")
+        for name, phase in report["phases"].items():
+            print(f"{name:>18} {phase['time']:10.4f} s {phase['calls']:8d} calls {phase['mean']*1e6:10.1f} us/call")
+        if "energy" in report:
+            energy = report["energy"]
+            print(f"stored {energy['stored']:.6g} J, injected {energy['injected']:.6g} J, lost {energy['lost']:.6g} J, "
+                  f"drift {energy['drift']:.3g} J ({energy['relativeDrift']:.2e})")
@@ -0,0 +1,148 @@
+import numpy as np, os, json
+
+# a recording is a directory holding
+#   meta.json   names, shapes, decimations and number of rows written so far
+#   series.bin  float64 rows of [step, time, *series values]
+#   frames.bin  temperature maps one after the other, in frameDtype
+#   frameIndex.bin  float64 rows of [step, time] for every frame
+# all the binary files are raw so that they can be opened as memory maps while being written
+
+class recorder:
+    # streams the time series and temperature maps of a simulation to disk as they are
+    # produced, keeping at most chunkSize series rows in memory
+    def __init__(self, path, seriesNames, frameShape=None, seriesDecimation=1, frameDecimation=10, chunkSize=1024, frameDtype="float32"):
+        self.path = path
+        self.seriesNames = list(seriesNames)
+        self.frameShape = None if frameShape is None else tuple(frameShape)
+        self.seriesDecimation = seriesDecimation
+        self.frameDecimation = frameDecimation
+        self.frameDtype = np.dtype(frameDtype)
+        self.seriesBuffer = np.empty((chunkSize, 2+len(self.seriesNames)))
+        self.seriesBuffered = 0
+        self.seriesCount = 0
+        self.frameCount = 0
+
+        os.makedirs(path, exist_ok=True)
+        self.seriesFile = open(os.path.join(path, "series.bin"), "wb")
+        self.framesFile = open(os.path.join(path, "frames.bin"), "wb")
+        self.frameIndexFile = open(os.path.join(path, "frameIndex.bin"), "wb")
+        self.writeMeta()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        self.close()
+
+    def wantsSeries(self, step):
+        return step % self.seriesDecimation == 0
+
+    def wantsFrame(self, step):
+        return self.frameShape is not None and step % self.frameDecimation == 0
+
+    def record(self, step, time, values):
+        if not self.wantsSeries(step):
+            return
+        self.seriesBuffer[self.seriesBuffered] = (step, time, *values)
+        self.seriesBuffered += 1
+        if self.seriesBuffered == len(self.seriesBuffer):
+            self.flush()
+
+    def recordFrame(self, step, time, frame):
+        if not self.wantsFrame(step):
+            return
+        np.asarray(frame, dtype=self.frameDtype).reshape(self.frameShape).tofile(self.framesFile)
+        np.array([step, time], dtype=float).tofile(self.frameIndexFile)
+        self.frameCount += 1
+
+    def flush(self):
+        self.seriesBuffer[:self.seriesBuffered].tofile(self.seriesFile)
+        self.seriesCount += self.seriesBuffered
+        self.seriesBuffered = 0
+        for file in (self.seriesFile, self.framesFile, self.frameIndexFile):
+            file.flush()
+        self.writeMeta()
+
+    def close(self):
+        if self.seriesFile.closed:
+            return
+        self.flush()
+        for file in (self.seriesFile, self.framesFile, self.frameIndexFile):
+            file.close()
+
+    def writeMeta(self):
+        meta = {
+            "seriesNames": self.seriesNames,
+            "seriesCount": self.seriesCount,
+            "seriesDecimation": self.seriesDecimation,
+            "frameShape": self.frameShape,
+            "frameDtype": self.frameDtype.str,
+            "frameCount": self.frameCount,
+            "frameDecimation": self.frameDecimation
+        }
+        # write then rename so that a reader never sees a partial file
+        metaPath = os.path.join(self.path, "meta.json")
+        with open(metaPath + ".tmp", "w") as f:
+            json.dump(meta, f)
+        os.replace(metaPath + ".tmp", metaPath)
+
+class recording:
+    # read only view of a recording directory, nothing is loaded until it is indexed
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.seriesNames:list[str] = self.meta["seriesNames"]
+        self.seriesCount:int = self.meta["seriesCount"]
+        self.frameCount:int = self.meta["frameCount"]
+        columns = 2+len(self.seriesNames)
+        self.seriesData = self.openMap("series.bin", np.float64, (self.seriesCount, columns))
+        self.frameIndex = self.openMap("frameIndex.bin", np.float64, (self.frameCount, 2))
+        if self.meta["frameShape"] is None:
+            self.frames = np.zeros((0, 0, 0))
+        else:
+            self.frames = self.openMap("frames.bin", np.dtype(self.meta["frameDtype"]), (self.frameCount, *self.meta["frameShape"]))
+
+    def openMap(self, name, dtype, shape):
+        # np.memmap refuses empty files
+        if shape[0] == 0:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(os.path.join(self.path, name), dtype=dtype, mode="r", shape=shape)
+
+    @property
+    def steps(self):
+        return self.seriesData[:,0]
+
+    @property
+    def time(self):
+        return self.seriesData[:,1]
+
+    def __getitem__(self, name):
+        return self.seriesData[:, 2+self.seriesNames.index(name)]
+
+def plotRecording(path, show=True):
+    # post processing of a recording: the time series of simulate() and an animation of the
+    # temperature maps, matplotlib is only needed here
+    from matplotlib import pyplot as plt
+    from replay import player
+    data = recording(path)
+
+    animations = []
+    if data.frameCount > 0:
+        animations.append(player(path))
+
+    timeFigure, timeAxis = plt.subplots()
+    for name in ("innerTemp", "sensorTemp"):
+        if name in data.seriesNames:
+            timeAxis.plot(data.time, data[name], label={"innerTemp": "Room Temperature", "sensorTemp": "sensor Temperature"}[name])
+    timeAxis.legend()
+    if "heaterPower" in data.seriesNames:
+        timeAxisPower = timeAxis.twinx()
+        timeAxisPower.plot(data.time, data["heaterPower"], "--", label="Heater Power")
+        timeAxisPower.set_ylabel("Heater Power [W]")
+        timeAxisPower.legend(loc="upper right")
+    timeAxis.set_ylabel("Temperature [C']")
+    timeAxis.set_xlabel("Time [s]")
+    if show:
+        plt.show()
+    return animations
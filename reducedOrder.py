@@ -0,0 +1,316 @@
+import numpy as np
+import scipy.linalg as linalg, scipy.sparse as sparse, scipy.sparse.linalg as sparseLinalg
+from main import room
+from controllers import controllerBank
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+class reducedModel:
+    # low order model of the response of some cells of a room to its heaters power, with the
+    # heat sinks held at their temperature. The conductor cells follow
+    #   C dT/dt = -L_cc T - L_cs T_s + B P
+    # which, with V the modes of L_cc v = lambda C v normalized so that V^T C V = I, splits
+    # into independent modes dz_k/dt = -lambda_k z_k + b_k P with b = V^T B, seen on the
+    # outputs through c = (output weights) V. Sampled every timeStep with the power held over
+    # the step this is exactly z' = a z + g P with a = exp(-lambda dt), g = (1-a)/lambda b.
+    # The cells of a room all have time constants of the same order, so no handful of modes
+    # carries the response from the heaters to a sensor. The model is rather the balanced
+    # truncation of the sampled modes to order states, which keeps the combinations of modes
+    # the heaters excite the most and the outputs see the most, with the heaters scaled by
+    # their power range.
+    #
+    # The outputs are the sensor cells of the room controllers and sensors, then the mean
+    # inner temperature, at the end of every step. errorBound is the sum of the absolute
+    # values of the impulse response of the gap between the sampled modes and the model,
+    # times the power range of each heater: the largest gap in Kelvin on each output for any
+    # heater powers within their minPower and maxPower, starting from the modelled state.
+    # initialErrorBound is the largest gap the initial state alone makes.
+    # Rooms with more than denseLimit conductor cells are too large for all their modes, the
+    # modes are then those of the room projected on the block Krylov space of L_cc^-1 C
+    # started from L_cc^-1 B and the outputs, of about krylovSize vectors, which matches the
+    # response of the room at steady state and its first moments. projectionGap, the same
+    # impulse sum between the projections on the whole space and on its first half, is then
+    # added to errorBound as an estimate of the gap to the room, it is no longer a bound.
+    def __init__(self, simulatedRoom:room, order=8, outputCells=None, denseLimit=2000, krylovSize=100):
+        if simulatedRoom.edgeSources is None:
+            simulatedRoom.buildArrays()
+        controllers = simulatedRoom.controllers
+        if outputCells is None:
+            outputCells = np.concatenate([controllers.sensorCells[:controllers.count], simulatedRoom.sensorsIndex])
+        self.outputCells = np.unique(np.asarray(outputCells, dtype=np.intp))
+        self.heaterCells = controllers.cells[:controllers.count].copy()
+        self.order = order
+        self.timeStep = None
+
+        conductors = np.flatnonzero(simulatedRoom.conductorMask)
+        sinks = np.flatnonzero(~simulatedRoom.conductorMask)
+        position = np.full(len(simulatedRoom.temps), -1)
+        position[conductors] = np.arange(len(conductors))
+        conductance = simulatedRoom.getConductanceMatrix()[conductors]
+        conductorConductance = conductance[:, conductors].tocsc()
+        capacities = simulatedRoom.capacities[conductors]
+        solve = sparseLinalg.factorized(conductorConductance)
+
+        # temperatures without any heater power, the outputs are the gap to it
+        self.referenceTemps = simulatedRoom.temps.copy()
+        self.referenceTemps[conductors] = solve(-(conductance[:, sinks] @ simulatedRoom.temps[sinks]))
+
+        # heaters injecting in a heat sink add nothing
+        inputs = np.zeros((len(conductors), controllers.count))
+        heaters = np.flatnonzero(position[self.heaterCells] >= 0)
+        inputs[position[self.heaterCells[heaters]], heaters] = 1
+        # outputs over all the cells, the heat sinks among them only add to the reference
+        innerIds = simulatedRoom.getInnerIds()
+        rows = np.concatenate([np.arange(len(self.outputCells)), np.full(len(innerIds), len(self.outputCells))])
+        coefficients = np.concatenate([np.ones(len(self.outputCells)), np.full(len(innerIds), 1/len(innerIds))])
+        cellOutputs = sparse.csr_matrix((coefficients, (rows, np.concatenate([self.outputCells, innerIds]))), shape=(len(self.outputCells)+1, len(simulatedRoom.temps)))
+        self.referenceOutputs = cellOutputs @ self.referenceTemps
+        outputs = cellOutputs[:, conductors].toarray()
+        self.powerRange = np.maximum(np.abs(controllers.minPower[:controllers.count]), np.abs(controllers.maxPower[:controllers.count]))
+
+        self.halfModes = None
+        if len(conductors) <= denseLimit:
+            rates, modes = linalg.eigh(conductorConductance.toarray(), np.diag(capacities))
+        else:
+            basis = getKrylovBasis(solve, capacities, np.hstack([inputs, outputs.T]), krylovSize)
+            rates, modes = getProjectedModes(conductorConductance, capacities, basis)
+            halfRates, halfModes = getProjectedModes(conductorConductance, capacities, basis[:, :basis.shape[1]//2])
+            self.halfRates = halfRates
+            self.halfModes = (halfModes.T @ inputs, outputs @ halfModes)
+        self.rates = rates # in 1/seconds
+        self.modeInputs = modes.T @ inputs # Kelvin per second per Watt, modes by heaters
+        self.modeOutputs = outputs @ modes # outputs by modes
+        self.modes = modes
+        self.conductors = conductors
+        self.capacities = capacities
+        self.reset(simulatedRoom.temps)
+
+    def reset(self, temps):
+        # sets the state of the modes from the temperatures of all the cells of the room, the
+        # model state follows on the next discretize
+        gap = temps[self.conductors] - self.referenceTemps[self.conductors]
+        self.modeState = self.modes.T @ (self.capacities * gap)
+        if self.timeStep is not None:
+            timeStep, self.timeStep = self.timeStep, None
+            self.discretize(timeStep)
+
+    def discretize(self, timeStep):
+        # balanced truncation of the modes sampled every timeStep, and its error bounds
+        if timeStep == self.timeStep:
+            return
+        self.timeStep = timeStep
+        decay = np.exp(-self.rates*timeStep)
+        gain = ((1-decay) / self.rates)[:,None] * self.modeInputs
+        scaledGain = gain * self.powerRange
+        # gramians of the diagonal system, sum over n of a^n g g^T a^n and a^n c^T c a^n
+        coupling = 1 / (1 - np.outer(decay, decay))
+        controllability = (scaledGain @ scaledGain.T) * coupling
+        observability = (self.modeOutputs.T @ self.modeOutputs) * coupling
+        controllabilityRoot = getSquareRoot(controllability)
+        observabilityRoot = getSquareRoot(observability)
+        left, singularValues, right = np.linalg.svd(observabilityRoot.T @ controllabilityRoot)
+        order = min(self.order, int(np.sum(singularValues > singularValues[0]*1e-14)))
+        self.hankelSingularValues = singularValues
+        scale = 1/np.sqrt(singularValues[:order])
+        transform = controllabilityRoot @ right[:order].T * scale
+        inverse = (left[:,:order] * scale).T @ observabilityRoot.T
+        self.transition = inverse @ (decay[:,None] * transform)
+        self.gain = inverse @ gain
+        self.outputMatrix = self.modeOutputs @ transform
+        self.state = inverse @ self.modeState
+
+        modes = (decay, gain, self.modeOutputs)
+        self.errorBound = getImpulseGap(modes, (self.transition, self.gain, self.outputMatrix)) @ self.powerRange
+        self.initialErrorBound = getFreeGap((decay, self.modeState, self.modeOutputs), (self.transition, self.state, self.outputMatrix))
+        self.projectionGap = np.zeros(len(self.modeOutputs))
+        if self.halfModes is not None:
+            halfInputs, halfOutputs = self.halfModes
+            halfDecay = np.exp(-self.halfRates*timeStep)
+            halfModes = (halfDecay, ((1-halfDecay) / self.halfRates)[:,None] * halfInputs, halfOutputs)
+            self.projectionGap = getImpulseGap(modes, halfModes) @ self.powerRange
+            self.errorBound = self.errorBound + self.projectionGap
+
+    def step(self, powers, timeStep):
+        self.discretize(timeStep)
+        self.state = self.transition @ self.state + self.gain @ powers
+
+    def getOutputs(self):
+        # temperatures of the output cells, then the mean inner temperature, at the end of the
+        # last step
+        if self.timeStep is None:
+            return self.referenceOutputs + self.modeOutputs @ self.modeState
+        return self.referenceOutputs + self.outputMatrix @ self.state
+
+    def getOutputIndex(self, cellId):
+        index = int(np.searchsorted(self.outputCells, cellId))
+        if index == len(self.outputCells) or self.outputCells[index] != cellId:
+            raise KeyError(f"cell {cellId} is not an output of the model")
+        return index
+
+def getSquareRoot(gramian):
+    # R with R R^T = gramian, for semi definite gramians that cholesky would refuse
+    values, vectors = np.linalg.eigh(gramian)
+    return vectors * np.sqrt(np.maximum(values, 0))
+
+def getKrylovBasis(solve, capacities, start, size):
+    # C orthonormal basis of the block Krylov space of L^-1 C from L^-1 start, each block
+    # orthogonalized twice against the previous ones and cut to its independent directions
+    blocks = []
+    block = np.column_stack([solve(column) for column in start.T])
+    while sum(previous.shape[1] for previous in blocks) < size:
+        for previous in blocks*2:
+            block -= previous @ (previous.T @ (capacities[:,None] * block))
+        values, vectors = np.linalg.eigh(block.T @ (capacities[:,None] * block))
+        kept = values > values.max()*1e-12
+        if not kept.any():
+            break
+        block = block @ (vectors[:,kept] / np.sqrt(values[kept]))
+        blocks.append(block)
+        block = np.column_stack([solve(capacities * column) for column in block.T])
+    return np.hstack(blocks)
+
+def getProjectedModes(conductance, capacities, basis):
+    # modes of the room restricted to the span of a C orthonormal basis
+    rates, vectors = linalg.eigh(basis.T @ (conductance @ basis), basis.T @ (capacities[:,None] * basis))
+    return rates, basis @ vectors
+
+def getResponses(transition, values, outputs, chunk=256):
+    # outputs of x' = A x from values on, chunk steps at a time (chunk, outputs, ...), for a
+    # diagonal A given as the vector of its decays or a dense one
+    diagonal = transition.ndim == 1
+    def advance(transition, values):
+        if diagonal:
+            return transition.reshape(-1, *([1]*(values.ndim-1))) * values
+        return np.tensordot(transition, values, axes=(1, 0))
+    steps = [values]
+    for _ in range(chunk-1):
+        steps.append(advance(transition, steps[-1]))
+    steps = np.stack(steps)
+    jump = transition**chunk if diagonal else np.linalg.matrix_power(transition, chunk)
+    while True:
+        yield np.moveaxis(np.tensordot(steps, outputs, axes=(1, 1)), -1, 1)
+        steps = advance(jump, steps.swapaxes(0, 1)).swapaxes(0, 1)
+
+def getImpulseGap(first, second, tolerance=1e-12):
+    # sum over the steps of |impulse response of first - of second|, outputs by inputs, the
+    # systems being (transition, gain, outputs) and summed until both responses have faded
+    total = 0
+    peak = 0
+    for firstValues, secondValues in zip(getResponses(*first), getResponses(*second)):
+        total = total + np.abs(firstValues - secondValues).sum(axis=0)
+        size = np.abs(firstValues[-1]).max() + np.abs(secondValues[-1]).max()
+        peak = max(peak, np.abs(firstValues).max() + np.abs(secondValues).max())
+        if size <= tolerance*peak:
+            return total
+
+def getFreeGap(first, second, tolerance=1e-12):
+    # largest gap on each output between the free responses of (transition, state, outputs)
+    largest = 0
+    peak = 0
+    for firstValues, secondValues in zip(getResponses(*first), getResponses(*second)):
+        largest = np.maximum(largest, np.abs(firstValues - secondValues).max(axis=0))
+        size = np.abs(firstValues[-1]).max() + np.abs(secondValues[-1]).max()
+        peak = max(peak, np.abs(firstValues).max() + np.abs(secondValues).max())
+        if size <= tolerance*peak or peak == 0:
+            return largest
+
+class reducedRoom:
+    # drop-in plant for the controller loop: steps a reducedModel under a copy of the
+    # controllers of the room it was built from, the same way room.transferHeat does, with
+    # the sensors noise drawn from a copy of the room generator so that both see the same
+    # readings. temps holds the model outputs and the controllers read their sensor from it.
+    def __init__(self, simulatedRoom:room, order=8, **modelArgs):
+        self.model = reducedModel(simulatedRoom, order, **modelArgs)
+        self.timeStep = simulatedRoom.timeStep
+        self.time = simulatedRoom.time
+        self.stepCount = simulatedRoom.stepCount
+        rng = np.random.default_rng()
+        rng.bit_generator.state = simulatedRoom.noiseRng.bit_generator.state
+        source = simulatedRoom.controllers
+        self.controllers = controllerBank(rng, source.noise)
+        for name in controllerBank.fields:
+            setattr(self.controllers, name, getattr(source, name).copy())
+        self.controllers.sensorReadings = source.sensorReadings.copy()
+        self.controllers.count = source.count
+        self.controllers.sensorCells[:source.count] = [self.model.getOutputIndex(cellId) for cellId in source.sensorCells[:source.count]]
+        self.model.discretize(self.timeStep)
+        self.temps = self.model.getOutputs()
+
+    def transferHeat(self):
+        self.controllers.update(self.temps, self.timeStep)
+        self.model.step(self.controllers.power[:self.controllers.count], self.timeStep)
+        self.temps = self.model.getOutputs()
+        self.stepCount += 1
+        self.time += self.timeStep
+
+    def getInnerTemp(self):
+        return float(self.temps[-1])
+
+    def getTemp(self, cellId):
+        return float(self.temps[self.model.getOutputIndex(cellId)])
+
+    def getErrorBound(self, cellId=None):
+        # bound in Kelvin on the gap to the room, in continuous time at the end of every step,
+        # of an output cell or of the mean inner temperature for any sequence of powers within
+        # the heaters limits, an estimate for rooms beyond denseLimit
+        self.model.discretize(self.timeStep)
+        index = len(self.temps)-1 if cellId is None else self.model.getOutputIndex(cellId)
+        return float(self.model.errorBound[index] + self.model.initialErrorBound[index])
+
+def piLoop(transition, gain, outputMatrix, reference, state, sensorOutputs, p, i, setpoint, minPower, maxPower, timeStep, steps, outputs, powers):
+    # steps the model under noiseless pi controllers from the given state, outputs and
+    # powers get one row per step
+    order = len(state)
+    heaterCount = len(p)
+    integral = np.zeros(heaterCount)
+    power = np.zeros(heaterCount)
+    nextState = np.zeros(order)
+    for step in range(steps):
+        for heater in range(heaterCount):
+            output = sensorOutputs[heater]
+            measured = reference[output]
+            for k in range(order):
+                measured += outputMatrix[output, k]*state[k]
+            error = setpoint[heater] - measured
+            integral[heater] += error*timeStep
+            power[heater] = min(max(p[heater]*error + i[heater]*integral[heater], minPower[heater]), maxPower[heater])
+            powers[step, heater] = power[heater]
+        for k in range(order):
+            value = 0.0
+            for l in range(order):
+                value += transition[k, l]*state[l]
+            for heater in range(heaterCount):
+                value += gain[k, heater]*power[heater]
+            nextState[k] = value
+        for k in range(order):
+            state[k] = nextState[k]
+        for output in range(outputs.shape[1]):
+            value = reference[output]
+            for k in range(order):
+                value += outputMatrix[output, k]*state[k]
+            outputs[step, output] = value
+
+compiledPiLoop = None if njit is None else njit(cache=True)(piLoop)
+
+def simulatePI(plant:reducedRoom, steps, p=None, i=None, setpoint=None):
+    # runs the plant for steps steps under noiseless pi controllers, the ones of the plant
+    # unless p, i or setpoint (one value or one per heater) are given, without changing the
+    # plant. Returns the outputs (steps, outputs), inner temperature last, and the powers
+    # (steps, heaters). Compiled with numba when it is installed, to try gains by the thousand.
+    model = plant.model
+    controllers = plant.controllers
+    count = controllers.count
+    def perHeater(value, default):
+        return default[:count].astype(float) if value is None else np.broadcast_to(np.asarray(value, dtype=float), (count,)).copy()
+    model.discretize(plant.timeStep)
+    reference = model.referenceOutputs
+    outputs = np.empty((steps, len(reference)))
+    powers = np.empty((steps, count))
+    loop = compiledPiLoop if compiledPiLoop is not None else piLoop
+    loop(np.ascontiguousarray(model.transition), np.ascontiguousarray(model.gain), np.ascontiguousarray(model.outputMatrix),
+         reference, model.state.copy(), controllers.sensorCells[:count].copy(), perHeater(p, controllers.p), perHeater(i, controllers.i), perHeater(setpoint, controllers.setpoint),
+         controllers.minPower[:count].astype(float), controllers.maxPower[:count].astype(float), float(plant.timeStep), steps, outputs, powers)
+    return outputs, powers
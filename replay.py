@@ -0,0 +1,85 @@
+import numpy as np, sys
+from matplotlib import pyplot as plt
+import matplotlib.animation as animation
+from recorder import recording
+
+class player:
+    # plays the temperature maps of a recording straight from its memory map: the image is
+    # created once and every frame only reads its own slice of frames.bin
+    #
+    # keys: space pause, left/right seek by skip frames, up/down double/halve skip,
+    #       home/end go to the first/last frame
+    def __init__(self, path, start=0, stop=None, skip=1, interval=10, clim=None):
+        self.data = recording(path)
+        if self.data.frameCount == 0:
+            raise ValueError(f"no temperature map recorded in {path}")
+        self.start = start
+        self.stop = self.data.frameCount if stop is None else min(stop, self.data.frameCount)
+        self.skip = max(int(skip), 1)
+        self.frame = start
+        self.paused = False
+
+        if clim is None:
+            clim = self.estimateColorLimits()
+        self.figure, self.axis = plt.subplots()
+        self.image = self.axis.imshow(self.data.frames[self.frame].T, cmap='hot', interpolation='nearest', vmin=clim[0], vmax=clim[1])
+        self.figure.colorbar(self.image, ax=self.axis, label="Temperature [C']")
+        self.figure.canvas.mpl_connect("key_press_event", self.onKey)
+        self.animation = animation.FuncAnimation(self.figure, self.draw, frames=self.frames, interval=interval, cache_frame_data=False)
+
+    def estimateColorLimits(self, samples=16):
+        # min and max over a few frames spread along the run instead of reading all of them
+        picked = np.unique(np.linspace(0, self.data.frameCount-1, samples).astype(int))
+        sampled = [np.asarray(self.data.frames[frame]) for frame in picked]
+        return float(min(frame.min() for frame in sampled)), float(max(frame.max() for frame in sampled))
+
+    def frames(self):
+        while True:
+            yield self.frame
+            if not self.paused:
+                self.frame += self.skip
+                if self.frame >= self.stop:
+                    self.frame = self.start
+
+    def draw(self, frame):
+        self.image.set_data(self.data.frames[frame].T)
+        step, time = self.data.frameIndex[frame]
+        self.axis.set_title(f"frame {frame} step {int(step)} t = {time:g} s")
+        return self.image,
+
+    def seek(self, frame):
+        self.frame = min(max(int(frame), self.start), self.stop-1)
+        self.draw(self.frame)
+        self.figure.canvas.draw_idle()
+
+    def seekTime(self, time):
+        # first frame recorded at or after time
+        return self.seek(np.searchsorted(self.data.frameIndex[:,1], time))
+
+    def onKey(self, event):
+        if event.key == " ":
+            self.paused = not self.paused
+        elif event.key == "right":
+            self.seek(self.frame + self.skip)
+        elif event.key == "left":
+            self.seek(self.frame - self.skip)
+        elif event.key == "up":
+            self.skip *= 2
+        elif event.key == "down":
+            self.skip = max(self.skip//2, 1)
+        elif event.key == "home":
+            self.seek(self.start)
+        elif event.key == "end":
+            self.seek(self.stop-1)
+
+def replay(path, start=0, stop=None, skip=1, interval=10, show=True):
+    replayPlayer = player(path, start, stop, skip, interval)
+    if show:
+        plt.show()
+    return replayPlayer
+
+def main():
+    replay(sys.argv[1] if len(sys.argv) > 1 else "simulation")
+
+if __name__ == "__main__":
+    main()
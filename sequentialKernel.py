@@ -0,0 +1,70 @@
+import numpy as np
+
+# the sequential engine of room as one function over flat arrays, compiled with numba when it
+# is installed and run as plain Python on lists otherwise. Both run the exact same code, so
+# they give bit for bit the same temperatures for the same inputs.
+#
+# The neighbor order of every cell is shuffled with its own generator, a Park-Miller minimal
+# standard generator whose products fit in 64 bits, instead of the random.sample calls of the
+# Python engine, so this engine reproduces itself exactly but not the sequential engine.
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+minstdModulus = 2147483647
+minstdMultiplier = 48271
+
+def seedState(seed):
+    # generator state for a room seed, the minimal standard generator needs 0 < state < modulus
+    return np.array([seed % (minstdModulus-1) + 1], dtype=np.int64)
+
+def sequentialStep(temps, resistances, capacities, conductors, neighborStarts, neighborIds, sortIndex, injected, timeStep, rngState, order):
+    # the neighbors of a cell are neighborIds[neighborStarts[cell]:neighborStarts[cell+1]], order
+    # is a scratch buffer as long as the largest neighbor count
+    state = rngState[0]
+    for selectedCell in sortIndex:
+        if injected[selectedCell] != 0:
+            temps[selectedCell] += injected[selectedCell] / capacities[selectedCell]
+        first = neighborStarts[selectedCell]
+        count = neighborStarts[selectedCell+1] - first
+        for k in range(count):
+            order[k] = k
+        # pick a random order for the neighbors, Fisher-Yates shuffle
+        for k in range(count-1, 0, -1):
+            state = (state * minstdMultiplier) % minstdModulus
+            swap = state % (k+1)
+            order[k], order[swap] = order[swap], order[k]
+        for k in range(count):
+            neighbor = neighborIds[first+order[k]]
+            sourceTemp = temps[selectedCell]
+            if sourceTemp < temps[neighbor]:
+                transfer = 0.0
+            else:
+                transfer = (sourceTemp - temps[neighbor]) / (resistances[selectedCell] + resistances[neighbor]) * timeStep
+                if conductors[neighbor]:
+                    temps[neighbor] += transfer / capacities[neighbor]
+            temps[selectedCell] += -transfer / capacities[selectedCell]
+    rngState[0] = state
+
+compiledSequentialStep = None if njit is None else njit(cache=True)(sequentialStep)
+
+def runSequentialStep(temps, resistances, capacities, conductors, neighborStarts, neighborIds, sortIndex, injected, timeStep, rngState, compiled=None):
+    # one step of the kernel updating temps and rngState in place, compiled picks the
+    # implementation and defaults to numba when it is installed
+    width = int(np.diff(neighborStarts).max(initial=0))
+    if compiled is None:
+        compiled = compiledSequentialStep is not None
+    if compiled:
+        if compiledSequentialStep is None:
+            raise RuntimeError("numba is not installed")
+        compiledSequentialStep(temps, resistances, capacities, conductors.astype(np.bool_), neighborStarts, neighborIds,
+                               np.ascontiguousarray(sortIndex), injected, float(timeStep), rngState, np.empty(width, dtype=np.int64))
+        return
+    tempsList = temps.tolist()
+    state = [int(rngState[0])]
+    sequentialStep(tempsList, resistances.tolist(), capacities.tolist(), conductors.tolist(), neighborStarts.tolist(), neighborIds.tolist(),
+                   sortIndex.tolist(), injected.tolist(), float(timeStep), state, [0]*width)
+    temps[:] = tempsList
+    rngState[0] = state[0]
@@ -0,0 +1,213 @@
+import asyncio, json, argparse, math, traceback
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+from main import room, buildTestRoom
+from controllers import controllerType
+
+class simulationServer:
+    # runs a room in real time, or realTimeFactor times faster, and serves its sensors and
+    # heaters over a small json HTTP API on localhost, to use the room as the plant of a
+    # thermostat under test:
+    #   GET  /state            time, step, sensors and heaters
+    #   GET  /sensors          noisy reading of every sensor of the room at the last step
+    #   GET  /heaters          power and mode of every heater
+    #   POST /heaters/<index>  {"power": Watts} takes the heater over, {"release": true} gives
+    #                          it back to its own controller
+    #   POST /clock            {"realTimeFactor": factor} and/or {"paused": true or false}
+    # The steps run in a worker thread on a clock of their own, the requests only read the
+    # state published after the last step and queue power commands applied before the next
+    # one, so neither slow clients nor many of them hold the simulation back. When a step
+    # takes longer than its real time the clock catches up by at most maxCatchUp steps and
+    # counts the steps it could not keep up with in lateSteps.
+    def __init__(self, simulatedRoom:room, host="127.0.0.1", port=8080, realTimeFactor=1, maxCatchUp=10):
+        self.room = simulatedRoom
+        self.host = host
+        self.port = port
+        self.realTimeFactor = realTimeFactor
+        self.maxCatchUp = maxCatchUp
+        self.paused = False
+        self.lateSteps = 0
+        self.commands = {}
+        # controller types of the heaters taken over, to give them back on release
+        self.automaticTypes = {}
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.server = None
+        # exception that stopped the steps, raised again by serve
+        self.error = None
+        self.publish()
+
+    def publish(self):
+        # state served until the next step, a new dict each time so that requests being
+        # answered keep a consistent one
+        controllers = self.room.controllers
+        readings = self.room.readSensors()
+        self.state = {
+            "time": self.room.time,
+            "step": self.room.stepCount,
+            "realTimeFactor": self.realTimeFactor,
+            "paused": self.paused,
+            "lateSteps": self.lateSteps,
+            "sensors": [{"index": k, "x": sensor.x, "y": sensor.y, "temp": float(reading)} for k, (sensor, reading) in enumerate(zip(self.room.sensors, readings))],
+            "heaters": [{"index": k, "x": heatSource.x, "y": heatSource.y, "power": float(controllers.power[k]),
+                         "mode": "manual" if k in self.automaticTypes else "auto"} for k, heatSource in enumerate(self.room.heatSources)]
+        }
+
+    def applyCommands(self):
+        commands, self.commands = self.commands, {}
+        for index, command in commands.items():
+            heatSource = self.room.heatSources[index]
+            if command.get("release"):
+                if index in self.automaticTypes:
+                    heatSource.type = self.automaticTypes.pop(index)
+            else:
+                if index not in self.automaticTypes:
+                    self.automaticTypes[index] = heatSource.type
+                    heatSource.type = controllerType.manual
+                heatSource.power = command["power"]
+
+    async def runClock(self):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time()
+        while True:
+            if self.paused:
+                await asyncio.sleep(0.05)
+                deadline = loop.time()
+                continue
+            self.applyCommands()
+            await loop.run_in_executor(self.executor, self.room.transferHeat)
+            self.publish()
+            deadline += self.room.timeStep / self.realTimeFactor
+            delay = deadline - loop.time()
+            if delay < -self.maxCatchUp*self.room.timeStep/self.realTimeFactor:
+                # too far behind, drop the steps that cannot be caught up
+                late = int(-delay / (self.room.timeStep/self.realTimeFactor))
+                self.lateSteps += late
+                deadline += late*self.room.timeStep/self.realTimeFactor
+            await asyncio.sleep(max(delay, 0))
+
+    def handle(self, method, path, body):
+        # (status, response) of a request
+        parts = [part for part in urlsplit(path).path.split("/") if part]
+        if method == "GET" and parts in (["state"], []):
+            return 200, self.state
+        if method == "GET" and parts == ["sensors"]:
+            return 200, self.state["sensors"]
+        if method == "GET" and parts == ["heaters"]:
+            return 200, self.state["heaters"]
+        if method == "POST" and len(parts) == 2 and parts[0] == "heaters":
+            try:
+                index = int(parts[1])
+                if index < 0:
+                    raise IndexError
+                self.room.heatSources[index]
+            except (ValueError, IndexError):
+                return 404, {"error": f"no heater {parts[1]}"}
+            if body.get("release"):
+                self.commands[index] = {"release": True}
+            elif isNumber(body.get("power")):
+                self.commands[index] = {"power": float(body["power"])}
+            else:
+                return 400, {"error": "expected {\"power\": finite Watts} or {\"release\": true}"}
+            return 202, {"index": index, "appliedAtStep": self.state["step"]+1}
+        if method == "POST" and parts == ["clock"]:
+            if "realTimeFactor" in body:
+                if not isNumber(body["realTimeFactor"]) or body["realTimeFactor"] <= 0:
+                    return 400, {"error": "realTimeFactor must be a positive finite number"}
+                self.realTimeFactor = body["realTimeFactor"]
+            if "paused" in body:
+                self.paused = bool(body["paused"])
+            # the steps may be paused, publish the clock now rather than after the next one,
+            # without reading the sensors again which would draw noise in the middle of a step
+            self.state = dict(self.state, realTimeFactor=self.realTimeFactor, paused=self.paused)
+            return 200, {"realTimeFactor": self.realTimeFactor, "paused": self.paused}
+        return 404, {"error": f"no route {method} {path}"}
+
+    async def handleConnection(self, reader:asyncio.StreamReader, writer:asyncio.StreamWriter):
+        # HTTP/1.1 with keep alive, one request after the other on each connection
+        try:
+            while True:
+                requestLine = await reader.readline()
+                if not requestLine:
+                    break
+                method, path, version = requestLine.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode("latin-1").strip()
+                    if not line:
+                        break
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                try:
+                    body = json.loads(body) if body else {}
+                except json.JSONDecodeError:
+                    body = None
+                if isinstance(body, dict):
+                    status, response = self.handle(method, path, body)
+                else:
+                    status, response = 400, {"error": "body is not a json object"}
+                content = json.dumps(response).encode()
+                keepAlive = headers.get("connection", "").lower() != "close" and version == "HTTP/1.1"
+                writer.write((f"HTTP/1.1 {status} {httpReasons[status]}\r\nContent-Type: application/json\r\n"
+                              f"Content-Length: {len(content)}\r\nConnection: {'keep-alive' if keepAlive else 'close'}\r\n\r\n").encode() + content)
+                await writer.drain()
+                if not keepAlive:
+                    break
+        except (ConnectionError, ValueError, asyncio.IncompleteReadError):
+            pass
+        except asyncio.CancelledError:
+            # the server is shutting down with the connection still open
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self):
+        self.server = await asyncio.start_server(self.handleConnection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        clock = asyncio.create_task(self.runClock())
+        clock.add_done_callback(self.onClockDone)
+        try:
+            async with self.server:
+                await self.server.serve_forever()
+        except asyncio.CancelledError:
+            if self.error is None:
+                raise
+            raise RuntimeError("the simulation stopped on an error") from self.error
+        finally:
+            clock.cancel()
+            self.executor.shutdown()
+
+    def onClockDone(self, clock:asyncio.Task):
+        # a step that raises ends the clock, stop serving rather than answer with a frozen state
+        if clock.cancelled() or clock.exception() is None:
+            return
+        self.error = clock.exception()
+        traceback.print_exception(type(self.error), self.error, self.error.__traceback__)
+        self.server.close()
+
+def isNumber(value):
+    # json.loads takes NaN and Infinity, a single one would spread to every temperature of the
+    # room and make /state unreadable for strict json parsers, and True is an int
+    return isinstance(value, (int, float)) and type(value) is not bool and math.isfinite(value)
+
+httpReasons = {200: "OK", 202: "Accepted", 400: "Bad Request", 404: "Not Found"}
+
+def main():
+    parser = argparse.ArgumentParser(description="serve a room in real time over HTTP on localhost")
+    parser.add_argument("--plan", help="floor plan json like templateRoom.json, the test room otherwise")
+    parser.add_argument("--engine", default=room.engineType.vectorized)
+    parser.add_argument("--time-step", type=float, default=10)
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--factor", type=float, default=1, help="simulated seconds per real second")
+    arguments = parser.parse_args()
+    if arguments.plan:
+        from floorplan import floorPlan
+        simulatedRoom = floorPlan.loadPlan(arguments.plan).buildRoom(arguments.time_step, arguments.engine)
+    else:
+        simulatedRoom = buildTestRoom(timeStep=arguments.time_step, engine=arguments.engine)
+    server = simulationServer(simulatedRoom, port=arguments.port, realTimeFactor=arguments.factor)
+    print(f"serving on http://127.0.0.1:{arguments.port}/state")
+    asyncio.run(server.serve())
+
+if __name__ == "__main__":
+    main()
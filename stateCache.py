@@ -0,0 +1,123 @@
+import numpy as np, os
+from collections import OrderedDict
+from main import room
+
+class stateCache:
+    # equilibrated room states keyed by room.configHash(), kept on disk as saveRoom files
+    # in directory and evicted least recently used first once there are more than maxEntries.
+    # The last maxMemoryEntries states used are also kept loaded in memory.
+    def __init__(self, directory, maxEntries=64, maxMemoryEntries=4):
+        self.directory = directory
+        self.maxEntries = maxEntries
+        self.maxMemoryEntries = maxMemoryEntries
+        self.memory:OrderedDict[str, room] = OrderedDict()
+        os.makedirs(directory, exist_ok=True)
+
+    def getPath(self, key):
+        return os.path.join(self.directory, key + ".room")
+
+    def __contains__(self, key):
+        return key in self.memory or os.path.exists(self.getPath(key))
+
+    def get(self, key):
+        # the cached room for key or None, marks it as the most recently used
+        path = self.getPath(key)
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            if os.path.exists(path):
+                os.utime(path)
+            return self.memory[key]
+        if not os.path.exists(path):
+            return None
+        os.utime(path)
+        cached = room.loadRoom(path)
+        self.remember(key, cached)
+        return cached
+
+    def put(self, key, cachedRoom:room):
+        # only written to disk, the room keeps being simulated by the caller after this
+        saveRoomAtomic(cachedRoom, self.getPath(key))
+        self.evict()
+
+    def remember(self, key, cachedRoom):
+        self.memory[key] = cachedRoom
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.maxMemoryEntries:
+            self.memory.popitem(last=False)
+
+    def evict(self):
+        # the access time is tracked with the file modification time so that the order
+        # survives between processes
+        entries = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(".room")]
+        entries.sort(key=os.path.getmtime)
+        for path in entries[:max(len(entries) - self.maxEntries, 0)]:
+            os.remove(path)
+            self.memory.pop(os.path.basename(path)[:-len(".room")], None)
+
+def saveRoomAtomic(savedRoom:room, path):
+    # write to a temporary file first so that a crash never leaves a truncated file behind
+    savedRoom.saveRoom(path + ".tmp")
+    os.replace(path + ".tmp", path)
+
+def equilibrate(simulatedRoom:room, tolerance=1e-3, window=100, maxSteps=100000):
+    # steps the room until the mean inner temperature of a window of steps moves by less
+    # than tolerance Kelvin from the previous window, returns the number of steps done
+    previousMean = None
+    for step in range(0, maxSteps, window):
+        innerTemps = np.empty(window)
+        for i in range(window):
+            simulatedRoom.transferHeat()
+            innerTemps[i] = simulatedRoom.getInnerTemp()
+        mean = innerTemps.mean()
+        if previousMean is not None and abs(mean - previousMean) < tolerance:
+            return step + window
+        previousMean = mean
+    return maxSteps
+
+def warmStart(simulatedRoom:room, cache:stateCache, **equilibrateArgs):
+    # puts the room in its equilibrium state, taken from the cache when a room with the same
+    # configuration was already equilibrated, returns True on a cache hit. Either way the
+    # room keeps its time and step count, equilibrating does not count as simulated time
+    key = simulatedRoom.configHash()
+    cached = cache.get(key)
+    if cached is not None:
+        simulatedRoom.copyStateFrom(cached)
+        return True
+    time, stepCount = simulatedRoom.time, simulatedRoom.stepCount
+    equilibrate(simulatedRoom, **equilibrateArgs)
+    simulatedRoom.time, simulatedRoom.stepCount = time, stepCount
+    cache.put(key, simulatedRoom)
+    return False
+
+def runWithCheckpoints(simulatedRoom:room, steps, checkpointPath, checkpointEvery=1000, onStep=None):
+    # runs the room until it has done steps steps in total, saving it to checkpointPath every
+    # checkpointEvery steps. When checkpointPath already exists the run resumes from it, so
+    # calling this again after a crash continues where the last checkpoint stopped.
+    # Returns the room that was run, which is the loaded one when resuming.
+    if os.path.exists(checkpointPath):
+        simulatedRoom = room.loadRoom(checkpointPath)
+    while simulatedRoom.stepCount < steps:
+        simulatedRoom.transferHeat()
+        if onStep is not None:
+            onStep(simulatedRoom)
+        if simulatedRoom.stepCount % checkpointEvery == 0 or simulatedRoom.stepCount == steps:
+            saveRoomAtomic(simulatedRoom, checkpointPath)
+    return simulatedRoom
+
+def checkSeedIndependence(seeds=range(6)):
+    # rooms that only differ by their seed must share a cache key, or every run of a sweep,
+    # which seeds each run on its own, would equilibrate from scratch
+    from main import buildTestRoom
+    from floorplan import floorPlan
+    builders = {
+        "test room": lambda seed: buildTestRoom(seed=seed),
+        "large test room": lambda seed: buildTestRoom(40, 40, seed=seed),
+        "template plan": lambda seed: floorPlan.loadPlan(os.path.join(os.path.dirname(os.path.abspath(__file__)), "templateRoom.json")).buildRoom(seed=seed)
+    }
+    for name, build in builders.items():
+        keys = {build(seed).configHash() for seed in seeds}
+        assert len(keys) == 1, f"{name}: {len(keys)} cache keys for {len(seeds)} seeds"
+        print(f"{name}: one cache key for {len(seeds)} seeds")
+
+if __name__ == "__main__":
+    checkSeedIndependence()
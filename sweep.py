@@ -0,0 +1,86 @@
+import numpy as np, os, csv, json, itertools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from main import buildTestRoom
+
+# metrics reported for every run of a sweep, after the configuration columns
+metricNames = ["settlingTime", "overshoot", "energy", "finalInnerTemp"]
+
+def configGrid(**axes):
+    # every combination of the given values, configGrid(p=[1, 10], width=[7, 20]) gives 4 configurations
+    names = list(axes)
+    return [dict(zip(names, values)) for values in itertools.product(*axes.values())]
+
+def runScenario(config):
+    # runs one simulate() like configuration without any plot and returns its metrics,
+    # config holds the buildTestRoom arguments plus "steps" and optionally "tolerance"
+    # (band around the setpoint in Kelvin used for the settling time)
+    config = dict(config)
+    steps = config.pop("steps", 600)
+    tolerance = config.pop("tolerance", 0.5)
+    setpoint = config.get("setpoint", 30)
+    testroom = buildTestRoom(**config)
+
+    innerTemps = np.empty(steps)
+    energy = 0
+    for step in range(steps):
+        testroom.transferHeat()
+        innerTemps[step] = testroom.getInnerTemp()
+        energy += sum(heatSource.power for heatSource in testroom.heatSources) * testroom.timeStep
+
+    # the run is settled from the step after the last one outside of the band
+    outside = np.flatnonzero(np.abs(innerTemps - setpoint) > tolerance)
+    if len(outside) == 0:
+        settlingTime = 0
+    elif outside[-1] == steps-1:
+        settlingTime = float("nan")
+    else:
+        settlingTime = (outside[-1]+1) * testroom.timeStep
+    return {
+        "settlingTime": settlingTime, # in seconds
+        "overshoot": max(float(innerTemps.max()) - setpoint, 0), # in Kelvin
+        "energy": energy, # in Joules
+        "finalInnerTemp": float(innerTemps[-1])
+    }
+
+def runIndexedScenario(index, config):
+    return index, runScenario(config)
+
+def sweep(configs, outputPath=None, workers=None, seed=0):
+    # runs the configurations on a pool of processes and writes one csv row per run as soon
+    # as it finishes, the rows come in completion order and carry the index of their
+    # configuration. Configurations without a "seed" get one derived from the sweep seed and
+    # their index, so a sweep gives the same results whatever the number of workers.
+    configs = [dict(config) for config in configs]
+    seeds = np.random.SeedSequence(seed).generate_state(len(configs))
+    for config, configSeed in zip(configs, seeds):
+        config.setdefault("seed", int(configSeed))
+    configNames = sorted({name for config in configs for name in config})
+    columns = ["index"] + configNames + metricNames
+
+    results = [None]*len(configs)
+    outputFile = open(outputPath, "w", newline="") if outputPath is not None else None
+    try:
+        if outputFile is not None:
+            writer = csv.DictWriter(outputFile, columns)
+            writer.writeheader()
+        with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            futures = [executor.submit(runIndexedScenario, index, config) for index, config in enumerate(configs)]
+            for future in as_completed(futures):
+                index, metrics = future.result()
+                row = {"index": index, **configs[index], **metrics}
+                results[index] = row
+                if outputFile is not None:
+                    writer.writerow({name: json.dumps(value) if isinstance(value, (list, tuple, dict)) else value for name, value in row.items()})
+                    outputFile.flush()
+    finally:
+        if outputFile is not None:
+            outputFile.close()
+    return results
+
+def main():
+    configs = configGrid(p=[1, 5, 10, 20], i=[0, 0.005, 0.01, 0.02], engine=["vectorized"])
+    for row in sweep(configs, "sweep.csv"):
+        print(row)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+import numpy as np, csv, itertools
+from main import room, cell
+
+class csvWeather:
+    # time series in a csv file with a header line, read chunkSize rows at a time. time is in
+    # seconds once multiplied by timeScale, 3600 for a file counting hours
+    def __init__(self, path, columns, timeColumn="time", timeScale=1, chunkSize=4096, delimiter=","):
+        self.path = path
+        self.columns = list(columns)
+        self.timeColumn = timeColumn
+        self.timeScale = timeScale
+        self.chunkSize = chunkSize
+        self.delimiter = delimiter
+
+    def readChunks(self):
+        # arrays of rows [time, *columns]
+        with open(self.path, newline="") as f:
+            reader = csv.reader(f, delimiter=self.delimiter)
+            header = [name.strip() for name in next(reader)]
+            indices = [header.index(name) for name in [self.timeColumn] + self.columns]
+            while True:
+                rows = list(itertools.islice(reader, self.chunkSize))
+                if not rows:
+                    return
+                # blank lines, at the end of a file mostly, can leave a chunk without any row
+                rows = [row for row in rows if any(value.strip() for value in row)]
+                if not rows:
+                    continue
+                chunk = np.array([[float(row[index]) for index in indices] for row in rows])
+                chunk[:,0] *= self.timeScale
+                yield chunk
+
+class binaryWeather:
+    # time series in a raw float64 file of rows [time, *columns], memory mapped so only the
+    # chunks being read are loaded
+    def __init__(self, path, columns, timeScale=1, chunkSize=4096):
+        self.path = path
+        self.columns = list(columns)
+        self.timeScale = timeScale
+        self.chunkSize = chunkSize
+
+    def readChunks(self):
+        data = np.memmap(self.path, dtype=np.float64, mode="r").reshape(-1, 1+len(self.columns))
+        for start in range(0, len(data), self.chunkSize):
+            chunk = np.array(data[start:start+self.chunkSize])
+            chunk[:,0] *= self.timeScale
+            yield chunk
+
+    @staticmethod
+    def write(path, times, values):
+        # writes times and a (rows, columns) array of values in the format read by binaryWeather
+        np.column_stack([times, values]).astype(np.float64).tofile(path)
+
+class weatherSeries:
+    # values of a csvWeather or binaryWeather source linearly interpolated at any time, holding
+    # one chunk of the file at a time. The times asked for are expected to mostly go forward,
+    # going back before the loaded chunk reads the file again from its start. Before the first
+    # row and after the last one the values are held.
+    def __init__(self, source):
+        self.source = source
+        self.columns = source.columns
+        self.restart()
+
+    def restart(self):
+        self.chunks = self.source.readChunks()
+        self.data = next(self.chunks, None)
+        if self.data is None:
+            raise ValueError(f"{self.source.path} holds no rows")
+        self.first = True # the loaded chunk is the first of the file
+        self.exhausted = False
+
+    def advance(self):
+        # next chunk, keeping the last row of the current one to interpolate across them
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.exhausted = True
+            return
+        self.data = np.concatenate([self.data[-1:], chunk])
+        self.first = False
+
+    def getValues(self, time):
+        if time < self.data[0,0] and not self.first:
+            self.restart()
+        while time > self.data[-1,0] and not self.exhausted:
+            self.advance()
+        times = self.data[:,0]
+        index = int(np.searchsorted(times, time, side="right"))
+        if index == 0:
+            return self.data[0,1:].copy()
+        if index == len(times):
+            return self.data[-1,1:].copy()
+        before, after = self.data[index-1], self.data[index]
+        weight = (time - before[0]) / (after[0] - before[0])
+        return before[1:] + weight*(after[1:] - before[1:])
+
+class boundaryConditions:
+    # sets the heat sinks of a room to the outdoor temperature of a weather series before every
+    # step, and optionally injects solar gains in some cells: irradiance in Watts/m^2 times
+    # solarArea m^2 per cell times solarTransmittance. The values are taken at the middle of the
+    # step, all the heat sinks, or sinkIds, are set with a single assignment.
+    def __init__(self, simulatedRoom:room, weather:weatherSeries, temperatureColumn="outerTemp", solarColumn=None,
+                 solarCells=None, solarArea=1, solarTransmittance=0.6, sinkIds=None):
+        self.room = simulatedRoom
+        self.weather = weather
+        self.temperatureIndex = weather.columns.index(temperatureColumn)
+        self.solarIndex = None if solarColumn is None else weather.columns.index(solarColumn)
+        if sinkIds is None:
+            sinkIds = np.flatnonzero(simulatedRoom.types == cell.cellType.heatSink)
+        self.sinkIds = np.asarray(sinkIds, dtype=np.intp)
+        self.solarCells = np.zeros(0, dtype=np.intp) if solarCells is None else np.asarray(solarCells, dtype=np.intp)
+        self.solarGain = solarArea*solarTransmittance
+
+    def attach(self):
+        # the room calls update at the start of every transferHeat from now on
+        self.room.boundary = self
+        if self.solarIndex is not None:
+            self.room.externalPowers = np.zeros(len(self.room.temps))
+        return self
+
+    def detach(self):
+        self.room.boundary = None
+        self.room.externalPowers = None
+
+    def update(self):
+        values = self.weather.getValues(self.room.time + self.room.timeStep/2)
+        self.room.temps[self.sinkIds] = values[self.temperatureIndex]
+        if self.solarIndex is not None:
+            self.room.externalPowers[self.solarCells] = max(values[self.solarIndex], 0) * self.solarGain